@@ -1,8 +1,19 @@
+import ctypes
+import logging
 import os
+import threading
+import itertools
+import time
 import wave
+from contextlib import contextmanager
 
 import pyaudio
 
+import metrics
+from pcm_source import PcmSource
+
+logger = logging.getLogger(__name__)
+
 
 # this plays a file from disk, which is recording for each Play/Stop transition
 # it could be a reference for how to stream the audio packets from the server
@@ -35,13 +46,61 @@ def play_wav(file_path):
     pa.terminate()
 
 
-class OpusCoder:
-    def __init__(self, sample_rate=48000, channels=1):
-        if hasattr(os, "uname") and os.uname().sysname == "Darwin":
-            os.environ["PYOGG_LIB_DIR"] = "/opt/homebrew/lib"  # for pyogg on macos
-            os.environ["DYLD_FALLBACK_LIBRARY_PATH"] = "/opt/homebrew/lib"  # for pyogg on macos
+def import_pyogg():
+    if hasattr(os, "uname") and os.uname().sysname == "Darwin":
+        os.environ["PYOGG_LIB_DIR"] = "/opt/homebrew/lib"  # for pyogg on macos
+        os.environ["DYLD_FALLBACK_LIBRARY_PATH"] = "/opt/homebrew/lib"  # for pyogg on macos
+
+    import pyogg  # Lazy import to ensure env vars are set
+    return pyogg
+
+
+# opus_encoder_ctl requests from opus_defines.h, pyogg doesn't wrap these
+OPUS_AUTO = -1000
+OPUS_SET_BITRATE_REQUEST = 4002
+OPUS_SET_VBR_REQUEST = 4006
+OPUS_SET_COMPLEXITY_REQUEST = 4010
+OPUS_SET_INBAND_FEC_REQUEST = 4012
+OPUS_SET_PACKET_LOSS_PERC_REQUEST = 4014
+
+# bitrates the server keeps encodes at, lowest first, streams step between them with link quality
+BITRATE_LADDER = (16000, 24000, 32000, 48000)
+
+
+class OpusSettings:
+    '''
+    Encoder controls: bitrate in bits per second (OPUS_AUTO lets libopus pick), complexity 0-10,
+    VBR on or off, and in-band FEC tuned for an expected packet_loss_perc.
+    Every field is always applied, so a pooled encoder never keeps the last stream's settings.
+    '''
+    def __init__(self, bitrate=OPUS_AUTO, complexity=10, vbr=True, fec=False, packet_loss_perc=0):
+        self.bitrate = bitrate
+        self.complexity = complexity
+        self.vbr = vbr
+        self.fec = fec
+        self.packet_loss_perc = packet_loss_perc
 
-        import pyogg  # Lazy import to ensure env vars are set
+    def apply(self, pyogg, opus_encoder):
+        # pyogg creates the native encoder on the first encode, the controls need it to exist now
+        if opus_encoder._encoder is None:
+            opus_encoder._encoder = opus_encoder._create_encoder()
+        for request, value in ((OPUS_SET_BITRATE_REQUEST, self.bitrate),
+                               (OPUS_SET_COMPLEXITY_REQUEST, self.complexity),
+                               (OPUS_SET_VBR_REQUEST, int(self.vbr)),
+                               (OPUS_SET_INBAND_FEC_REQUEST, int(self.fec)),
+                               (OPUS_SET_PACKET_LOSS_PERC_REQUEST, self.packet_loss_perc)):
+            result = pyogg.opus.opus_encoder_ctl(opus_encoder._encoder, ctypes.c_int(request), ctypes.c_int(value))
+            if result != 0:
+                raise ValueError(f"opus_encoder_ctl({request}, {value}) failed with {result}")
+
+    def __repr__(self):
+        return (f"OpusSettings(bitrate={self.bitrate}, complexity={self.complexity}, vbr={self.vbr}, "
+                f"fec={self.fec}, packet_loss_perc={self.packet_loss_perc})")
+
+
+class OpusCoder:
+    def __init__(self, sample_rate=48000, channels=1, settings=None):
+        pyogg = import_pyogg()
 
         self.sample_rate = sample_rate
         self.channels = channels
@@ -50,6 +109,8 @@ class OpusCoder:
         self.opus_encoder.set_application("audio")
         self.opus_encoder.set_sampling_frequency(sample_rate)
         self.opus_encoder.set_channels(channels)
+        if settings is not None:
+            settings.apply(pyogg, self.opus_encoder)
 
         self.opus_decoder = pyogg.OpusDecoder()
         self.opus_decoder.set_sampling_frequency(sample_rate)
@@ -57,8 +118,152 @@ class OpusCoder:
 
     def encode(self, pcm_audio_bytes):
         # why is this 2048 bytes long when the chunk size is 1024?
-        print(f"audio.py: Encoding audio chunk {len(pcm_audio_bytes)} long")
+        # because the chunk size is in samples and each 16 bit sample is 2 bytes
+        logger.debug("Encoding audio chunk %d long", len(pcm_audio_bytes))
         return self.opus_encoder.encode(pcm_audio_bytes)
 
     def decode(self, opus_audio_bytes):
+        # a batched AudioPacket carries a list of frames, decode each one and join the PCM
+        if isinstance(opus_audio_bytes, (list, tuple)):
+            return b"".join(bytes(self.opus_decoder.decode(bytearray(frame))) for frame in opus_audio_bytes)
         return self.opus_decoder.decode(opus_audio_bytes)
+
+
+class OpusEncoderPool:
+    '''
+    A capped set of Opus encoders that streams check out one at a time.
+
+    An Opus encoder carries state from frame to frame, so two streams must never share one.
+    The settings are kept here once and every encoder is built with them, an encoder handed
+    back is reset with OPUS_RESET_STATE instead of being destroyed, so a play doesn't pay
+    for allocating a new one. acquire() blocks when max_encoders are all checked out.
+    Bitrate and the other OpusSettings are applied on every checkout, the default settings when none are given.
+    '''
+    def __init__(self, sample_rate=48000, channels=1, application="audio", max_encoders=8):
+        self.pyogg = import_pyogg()
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.application = application
+        self.max_encoders = max_encoders
+        self.live_encoders = 0
+        self._idle = []
+        self._cond = threading.Condition()
+
+    def _create_encoder(self):
+        opus_encoder = self.pyogg.OpusEncoder()
+        opus_encoder.set_application(self.application)
+        opus_encoder.set_sampling_frequency(self.sample_rate)
+        opus_encoder.set_channels(self.channels)
+        return opus_encoder
+
+    def _reset_encoder(self, opus_encoder):
+        # pyogg creates the native encoder on the first encode, nothing to reset before that
+        if getattr(opus_encoder, "_encoder", None) is not None:
+            self.pyogg.opus.opus_encoder_ctl(opus_encoder._encoder, ctypes.c_int(self.pyogg.opus.OPUS_RESET_STATE))
+
+    def acquire(self, timeout=None, settings=None):
+        """Check out an encoder set up with settings, waiting up to timeout seconds if the pool is exhausted."""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._idle or self.live_encoders < self.max_encoders, timeout):
+                raise TimeoutError(f"all {self.max_encoders} Opus encoders are in use")
+            opus_encoder = self._idle.pop() if self._idle else None
+            if opus_encoder is None:
+                self.live_encoders += 1
+        try:
+            if opus_encoder is None:
+                opus_encoder = self._create_encoder()
+            (settings or OpusSettings()).apply(self.pyogg, opus_encoder)
+            return opus_encoder
+        except Exception:
+            with self._cond:
+                self.live_encoders -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, opus_encoder):
+        """Reset an encoder and hand it back to the pool."""
+        self._reset_encoder(opus_encoder)
+        with self._cond:
+            self._idle.append(opus_encoder)
+            self._cond.notify()
+
+    @contextmanager
+    def encoder(self, timeout=None, settings=None):
+        opus_encoder = self.acquire(timeout, settings)
+        try:
+            yield opus_encoder
+        finally:
+            self.release(opus_encoder)
+
+
+class OpusDecoderPool:
+    '''
+    Opus decoders for uploaded audio, the decode side of OpusEncoderPool.
+
+    A decoder also carries state between frames, so each upload checks one out for its whole stream.
+    Returned decoders are reset and reused, acquire() raises TimeoutError once max_decoders are all in use.
+    '''
+    def __init__(self, sample_rate=48000, channels=1, max_decoders=64):
+        self.pyogg = import_pyogg()
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.max_decoders = max_decoders
+        self.live_decoders = 0
+        self._idle = []
+        self._cond = threading.Condition()
+
+    def _create_decoder(self):
+        opus_decoder = self.pyogg.OpusDecoder()
+        opus_decoder.set_sampling_frequency(self.sample_rate)
+        opus_decoder.set_channels(self.channels)
+        return opus_decoder
+
+    def acquire(self, timeout=None):
+        """Check out a decoder, waiting up to timeout seconds if the pool is exhausted."""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._idle or self.live_decoders < self.max_decoders, timeout):
+                raise TimeoutError(f"all {self.max_decoders} Opus decoders are in use")
+            if self._idle:
+                return self._idle.pop()
+            self.live_decoders += 1
+        try:
+            return self._create_decoder()
+        except Exception:
+            with self._cond:
+                self.live_decoders -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, opus_decoder):
+        # like the encoder, the native decoder only exists after the first decode
+        if getattr(opus_decoder, "_decoder", None) is not None:
+            self.pyogg.opus.opus_decoder_ctl(opus_decoder._decoder, ctypes.c_int(self.pyogg.opus.OPUS_RESET_STATE))
+        with self._cond:
+            self._idle.append(opus_decoder)
+            self._cond.notify()
+
+    @contextmanager
+    def decoder(self, timeout=None):
+        opus_decoder = self.acquire(timeout)
+        try:
+            yield opus_decoder
+        finally:
+            self.release(opus_decoder)
+
+
+def encode_wav(file_path, opus_coder, frame_duration=20/1000, start=0, count=None):
+    '''
+    Read a 16 bit PCM wave file and encode all of it into a list of Opus packets, one per frame.
+    Frames come straight out of the memory-mapped file, the last partial frame is padded with silence
+    because the encoder only accepts whole frames.
+    start and count encode only part of the file, in frames, for the segments of batch_encode.
+    https://pyogg.readthedocs.io/en/latest/examples.html
+    '''
+    packets = []
+    with PcmSource(file_path) as source:
+        frame_size = int(frame_duration * source.sample_rate)
+        for chunk in itertools.islice(source.frames(frame_size, start), count):
+            started = time.perf_counter()
+            packets.append(bytes(opus_coder.encode(chunk)))
+            metrics.ENCODE_SECONDS.observe(time.perf_counter() - started)
+    return packets
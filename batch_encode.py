@@ -0,0 +1,123 @@
+'''
+Encodes WAV assets on every core. A clip is cut into segments at frame boundaries and each segment is
+encoded in its own process, then the packet lists are joined back in order.
+
+An Opus encoder carries state from frame to frame, so a segment starts preroll frames early with a fresh
+encoder and those packets are thrown away. By the segment's first frame the encoder has settled and the
+seam can't be heard.
+
+As a script it precompiles a directory of assets into a packet pack, which the server maps with --packet-pack:
+
+    python batch_encode.py . -o assets.pack --workers 8
+'''
+import logging
+import math
+import multiprocessing
+import os
+import time
+from concurrent import futures
+
+import audio
+from pcm_source import PcmSource
+
+logger = logging.getLogger(__name__)
+
+# each worker process keeps its encoders between segments, they are reset when handed back
+_encoder_pool = None
+
+
+def _encode_segment(file_path, frame_duration, bitrate, start, count, preroll):
+    """Encode count frames of file_path from frame start, runs in a worker process."""
+    global _encoder_pool
+    if _encoder_pool is None:
+        _encoder_pool = audio.OpusEncoderPool()
+    first = max(0, start - preroll)
+    if count is not None:
+        count += start - first
+    with _encoder_pool.encoder(settings=audio.OpusSettings(bitrate=bitrate)) as opus_encoder:
+        packets = audio.encode_wav(file_path, opus_encoder, frame_duration, first, count)
+    return packets[start - first:]
+
+
+class BatchEncoder():
+    '''
+    A process pool that encodes 48kHz mono 16 bit WAVs split into segment_seconds segments.
+    Processes are spawned rather than forked, forking a process that has gRPC threads running is not safe.
+    '''
+    def __init__(self, workers=None, segment_seconds=10, preroll_frames=3):
+        self.workers = workers or os.cpu_count()
+        self.segment_seconds = segment_seconds
+        self.preroll_frames = preroll_frames
+        self._pool = futures.ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+
+    def segments(self, file_path, frame_duration):
+        """(start, count) of each segment of file_path, in frames, the last one's count is None to take the tail."""
+        with PcmSource(file_path) as source:
+            frame_size = int(frame_duration * source.sample_rate)
+            total = math.ceil(source.nframes / frame_size)
+        per_segment = max(1, int(self.segment_seconds / frame_duration))
+        starts = list(range(0, total, per_segment)) or [0]
+        return [(start, per_segment) for start in starts[:-1]] + [(starts[-1], None)]
+
+    def encode(self, file_path, frame_duration, bitrate):
+        """Opus packets for all of file_path, the same list encode_wav gives but built in parallel."""
+        started = time.monotonic()
+        segments = self.segments(file_path, frame_duration)
+        jobs = [self._pool.submit(_encode_segment, file_path, frame_duration, bitrate, start, count,
+                                  self.preroll_frames)
+                for start, count in segments]
+        packets = []
+        for job in jobs:
+            packets.extend(job.result())
+        logger.debug("encoded %s in %d segments in %.2fs", file_path, len(segments), time.monotonic() - started)
+        return packets
+
+    def close(self):
+        self._pool.shutdown(wait=True, cancel_futures=True)
+
+
+def compile_assets(directory, output, workers=None, frame_duration=20/1000, bitrates=audio.BITRATE_LADDER,
+                   segment_seconds=10):
+    """Prepare and encode every WAV in directory at each bitrate into a packet pack at output, returns the clip count."""
+    # imported here so the worker processes, which import this module, don't load NumPy
+    from packet_cache import EncodedClip, file_digest
+    from packet_pack import write_pack
+    from preprocess import AssetPreparer
+
+    preparer = AssetPreparer()
+    encoder = BatchEncoder(workers, segment_seconds)
+    clips = []
+    try:
+        names = sorted(name for name in os.listdir(directory) if name.lower().endswith(".wav"))
+        for name in names:
+            file_path = os.path.join(directory, name)
+            digest = file_digest(file_path)
+            prepared = preparer.prepare(file_path, digest)
+            for bitrate in bitrates:
+                packets = encoder.encode(prepared, frame_duration, bitrate)
+                clips.append((name, EncodedClip(packets, frame_duration, digest=digest, bitrate=bitrate)))
+                logger.info("encoded %s into %d packets at %d bps", name, len(packets), bitrate)
+    finally:
+        encoder.close()
+    write_pack(output, clips)
+    return len(clips)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Encode a directory of WAV assets into a packet pack")
+    parser.add_argument("directory")
+    parser.add_argument("-o", "--output", default="assets.pack")
+    parser.add_argument("--workers", type=int, default=None, help="encoder processes, default one per core")
+    parser.add_argument("--frame-duration-ms", type=float, default=20)
+    parser.add_argument("--bitrate", type=int, action="append", dest="bitrates",
+                        help="encode at this bitrate, repeat for each one, default every rung of the bitrate ladder")
+    parser.add_argument("--segment-seconds", type=float, default=10,
+                        help="clips are split into segments this long, each encoded in its own process")
+    args = parser.parse_args()
+    logging.basicConfig(level="INFO", format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    started = time.monotonic()
+    count = compile_assets(args.directory, args.output, args.workers, args.frame_duration_ms / 1000,
+                           args.bitrates or audio.BITRATE_LADDER, args.segment_seconds)
+    logger.info("wrote %d clips to %s in %.2fs", count, args.output, time.monotonic() - started)
@@ -0,0 +1,60 @@
+import logging
+
+import metrics
+from audio import BITRATE_LADDER
+
+logger = logging.getLogger(__name__)
+
+
+class BitrateController():
+    '''
+    Picks the bitrate rung for one audio stream from how the link is keeping up.
+
+    After every packet the stream reports its pacing lag (how far behind its release time the packet
+    went out) and how long the send blocked on gRPC flow control. Both stay near zero on a healthy link.
+    down_after congested packets in a row step down one rung, then the controller holds for hold_seconds
+    so the lower rate has time to drain the backlog. up_seconds of clean packets in a row step back up.
+    packet_duration is the audio in one packet, frame duration times frames per packet, the thresholds
+    and packet counts are all worked out from it.
+    '''
+    def __init__(self, packet_duration=20/1000, ladder=BITRATE_LADDER, down_after=3, up_seconds=5.0, hold_seconds=1.0):
+        self.ladder = ladder
+        self.rung = len(ladder) - 1
+        # more than a couple of packets late, or a send that blocks for most of a packet, is congestion
+        self.lag_threshold = 2 * packet_duration
+        self.send_threshold = 0.5 * packet_duration
+        self.down_after = down_after
+        self.up_after = max(1, round(up_seconds / packet_duration))
+        self.hold = max(1, round(hold_seconds / packet_duration))
+        self._congested = 0
+        self._clean = 0
+        self._holding = 0
+
+    @property
+    def bitrate(self):
+        return self.ladder[self.rung]
+
+    def observe(self, lag, send_seconds):
+        """Record one sent packet and return the bitrate to use from the next one on."""
+        metrics.PACING_LAG.observe(max(0.0, lag))
+        if self._holding:
+            self._holding -= 1
+            return self.bitrate
+        if lag > self.lag_threshold or send_seconds > self.send_threshold:
+            self._congested += 1
+            self._clean = 0
+            if self._congested >= self.down_after and self.rung > 0:
+                self.rung -= 1
+                self._congested = 0
+                self._holding = self.hold
+                metrics.BITRATE_SWITCHES.inc(direction="down")
+                logger.info("stream congested (lag %.3fs, send %.3fs), down to %d bps", lag, send_seconds, self.bitrate)
+        else:
+            self._clean += 1
+            self._congested = 0
+            if self._clean >= self.up_after and self.rung < len(self.ladder) - 1:
+                self.rung += 1
+                self._clean = 0
+                metrics.BITRATE_SWITCHES.inc(direction="up")
+                logger.info("stream recovered, up to %d bps", self.bitrate)
+        return self.bitrate
@@ -0,0 +1,204 @@
+'''
+Group playback: a clip played on many devices at the same moment is released by one producer per
+(asset, format, start time). The producer sends each packet once on the media clock and hands the same
+packet objects to every subscribed audio stream, so a fleet-wide announcement costs one encode and one pacing loop.
+'''
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Subscriber():
+    '''
+    Bounded queue of (frames, packet) items for one audio stream, for the threaded server.
+
+    The producer never waits for a subscriber. A stream that falls behind has its oldest packet
+    dropped, and the device hears a skip instead of the whole broadcast stalling.
+    '''
+    def __init__(self, maxlen=25):
+        self._items = deque(maxlen=maxlen)
+        self._cond = threading.Condition()
+        self._ended = False
+        self.dropped = 0
+
+    def offer(self, item):
+        with self._cond:
+            if len(self._items) == self._items.maxlen:
+                self.dropped += 1
+                metrics.BROADCAST_DROPPED.inc()
+            self._items.append(item)
+            self._cond.notify()
+
+    def end(self):
+        with self._cond:
+            self._ended = True
+            self._cond.notify()
+
+    @property
+    def finished(self):
+        """The broadcast has ended and everything it sent has been taken."""
+        return self._ended and not self._items
+
+    def get(self, timeout=None):
+        """Next item, or None on timeout or once finished."""
+        with self._cond:
+            self._cond.wait_for(lambda: self._items or self._ended, timeout)
+            return self._items.popleft() if self._items else None
+
+
+class AsyncSubscriber(Subscriber):
+    '''
+    Subscriber for the grpc.aio server. The producer offers from the timer wheel thread, so the
+    stream is only woken through the event loop when it is actually waiting.
+    '''
+    def __init__(self, maxlen=25):
+        super().__init__(maxlen)
+        self._loop = asyncio.get_running_loop()
+        self._ready = asyncio.Event()
+        self._waiting = False
+
+    def _wake(self):
+        # called with self._cond held
+        if self._waiting:
+            self._waiting = False
+            self._loop.call_soon_threadsafe(self._ready.set)
+
+    def offer(self, item):
+        super().offer(item)
+        with self._cond:
+            self._wake()
+
+    def end(self):
+        super().end()
+        with self._cond:
+            self._wake()
+
+    async def get(self, timeout=None):
+        """Next item, or None on timeout or once finished."""
+        with self._cond:
+            if self._items:
+                return self._items.popleft()
+            if self._ended:
+                return None
+            self._ready.clear()
+            self._waiting = True
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        with self._cond:
+            self._waiting = False
+            return self._items.popleft() if self._items else None
+
+
+class BroadcastProducer():
+    '''
+    Releases a list of (frames, packet) items to its subscribers on a Pacer, from timer wheel callbacks,
+    so a broadcast has no thread of its own. A subscriber that joins late starts at the current packet.
+    '''
+    def __init__(self, items, pacer):
+        self.items = items
+        self.pacer = pacer
+        self.next_index = 0
+        self.on_finish = None
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._finished = False
+
+    def start(self):
+        # the first stream may have spent a while encoding the clip, join the broadcast where it is now
+        now = time.monotonic()
+        while (self.next_index < len(self.items)
+               and self.pacer.release_time(self.next_index + self.pacer.lead_frames) < now):
+            self.next_index += 1
+        self.pacer.wheel.schedule(self.pacer.release_time(self.next_index), self._release)
+
+    def add(self, subscriber):
+        """Subscribe, returns False if the broadcast is already over."""
+        with self._lock:
+            if self._finished:
+                return False
+            self._subscribers.add(subscriber)
+        metrics.BROADCAST_SUBSCRIBERS.inc()
+        return True
+
+    def remove(self, subscriber):
+        with self._lock:
+            if subscriber not in self._subscribers:
+                return
+            self._subscribers.discard(subscriber)
+        metrics.BROADCAST_SUBSCRIBERS.dec()
+
+    def _release(self):
+        now = time.monotonic()
+        with self._lock:
+            subscribers = list(self._subscribers)
+        if not subscribers:
+            # every device stopped or disconnected, no one is left to send to
+            self._finish()
+            return
+        # everything due by now goes out in one wakeup, the lead packets at the start are all due at once
+        while self.next_index < len(self.items) and self.pacer.release_time(self.next_index) <= now:
+            item = self.items[self.next_index]
+            for subscriber in subscribers:
+                subscriber.offer(item)
+            self.next_index += 1
+        if self.next_index < len(self.items):
+            self.pacer.wheel.schedule(self.pacer.release_time(self.next_index), self._release)
+        else:
+            self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._finished = True
+            subscribers, self._subscribers = self._subscribers, set()
+        for subscriber in subscribers:
+            subscriber.end()
+        metrics.BROADCAST_SUBSCRIBERS.dec(len(subscribers))
+        if self.on_finish:
+            self.on_finish()
+
+
+class BroadcastHub():
+    '''
+    The running broadcasts, keyed by (asset, frame duration, frames per packet, start time).
+    Streams that negotiated the same format for the same broadcast share a producer.
+    '''
+    def __init__(self):
+        self._producers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, key, create, subscriber):
+        '''
+        Add subscriber to the producer for key, calling create() to make and start it for the first subscriber.
+        Returns the producer. If the broadcast has already ended the subscriber is ended straight away.
+        '''
+        with self._lock:
+            producer = self._producers.get(key)
+            created = producer is None
+            if created:
+                producer = create()
+                producer.on_finish = lambda: self._remove(key, producer)
+                self._producers[key] = producer
+        if not producer.add(subscriber):
+            subscriber.end()
+        if created:
+            # only start once the first subscriber is in, or the first release could find nobody and finish
+            producer.start()
+            logger.info("started broadcast %s", key)
+        return producer
+
+    def _remove(self, key, producer):
+        with self._lock:
+            if self._producers.get(key) is producer:
+                del self._producers[key]
+        logger.info("broadcast %s finished", key)
+
+    def __len__(self):
+        return len(self._producers)
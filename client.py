@@ -4,8 +4,8 @@ import queue
 import signal
 import sys
 import threading
+import time
 import wave
-import subprocess
 from datetime import datetime
 
 import grpc
@@ -17,8 +17,23 @@ from PyQt6.QtWidgets import QApplication, QLabel, QLineEdit, QPushButton, QWidge
 import comms_pb2, comms_pb2_grpc
 # from audio import OpusCoder, play_wav
 from audio import OpusCoder
+from playback import PrerollBuffer, StreamingPlayer, make_sink, trim_pcm
 
 DEVICE_ID = "test_client"
+# Opus frame duration and frames per AudioPacket requested from the server, 0 uses the server default
+AUDIO_FRAME_DURATION_US = 20000
+AUDIO_FRAMES_PER_PACKET = 1
+# frames of the selected clip the server sends ahead on a Mode press, so Play is heard at once. 0 turns it off
+AUDIO_PREROLL_FRAMES = 10
+# where received audio is played: "pw-play", "null", or a .wav file path for headless runs
+AUDIO_OUTPUT = "pw-play"
+# also save every clip to audio_recordings/client/
+RECORD_AUDIO = False
+# seconds to wait before re-opening a dropped audio stream, doubled on every failed attempt up to the max
+AUDIO_RECONNECT_DELAY = 0.5
+AUDIO_RECONNECT_MAX_DELAY = 8.0
+# button events sent ahead of their acks, a press only waits once this many are unacknowledged
+EVENT_WINDOW = 8
 
 STREAMS = [
     "status",
@@ -86,6 +101,8 @@ class App(QWidget):
         self.status_thread = None
         self.channel = None
         self.mode = 0
+        # pre-roll from the last Mode press, played as soon as Play is clicked
+        self.preroll = None
 
         # Add audio recording setup
         self.audio = pyaudio.PyAudio()
@@ -130,7 +147,7 @@ class App(QWidget):
         # Play
         button4 = QPushButton("Play", self)
         button4.setGeometry(145, 312, 48, 48)  # Right side button
-        button4.clicked.connect(lambda: self.event_queue.put({"button_id": comms_pb2.ButtonEvent.ButtonId.BUTTON_4}))
+        button4.clicked.connect(self.handle_play_click)
 
         # Device ID input
         # Add label above device ID input
@@ -180,6 +197,12 @@ class App(QWidget):
         # Turn off all mode LEDs
         self.event_queue.put({"button_id": comms_pb2.ButtonEvent.ButtonId.BUTTON_3})
 
+    def handle_play_click(self):
+        self.event_queue.put({"button_id": comms_pb2.ButtonEvent.ButtonId.BUTTON_4})
+        # don't wait for the server, start on the pre-roll it sent for this mode
+        if self.preroll is not None:
+            self.preroll.commit()
+
     def handle_mode_click(self):
         self.event_queue.put({"button_id": comms_pb2.ButtonEvent.ButtonId.BUTTON_2})
 
@@ -235,7 +258,8 @@ class App(QWidget):
                 led_5=comms_pb2.RGBAColor(rgba=((self.circle.color.rgb() << 8) | 0xFF) & 0xFFFFFFFF),
             )
             status_message = comms_pb2.DeviceStatusResponse(state=device_state)
-        elif response.set:
+        elif response.HasField("set"):
+            # the server only sends the LEDs that changed, an LED that isn't set keeps its color
             print("Received Status SET request.")
             # Shifting colors by 8 bits to go from RGBA to RGB
             # Ignore Led 0, it is the CONNECT LED
@@ -243,23 +267,23 @@ class App(QWidget):
             #     color = response.set.led_0.rgba >> 8
             #     self.led_0.color = QColor(color)
             #     self.led_0.update()
-            if response.set.led_1:
+            if response.set.HasField("led_1"):
                 color = response.set.led_1.rgba >> 8
                 self.led_1.color = QColor(color)
                 self.led_1.update()
-            if response.set.led_2:
+            if response.set.HasField("led_2"):
                 color = response.set.led_2.rgba >> 8
                 self.square.color = QColor(color)
                 self.square.update()
-            if response.set.led_3:
+            if response.set.HasField("led_3"):
                 color = response.set.led_3.rgba >> 8
                 self.rhomboid.color = QColor(color)
                 self.rhomboid.update()
-            if response.set.led_4:
+            if response.set.HasField("led_4"):
                 color = response.set.led_4.rgba >> 8
                 self.triangle.color = QColor(color)
                 self.triangle.update()
-            if response.set.led_5:
+            if response.set.HasField("led_5"):
                 color = response.set.led_5.rgba >> 8
                 self.circle.color = QColor(color)
                 self.circle.update()
@@ -285,13 +309,31 @@ class App(QWidget):
         if "event" in STREAMS:
             event_response_generator = stub.EventStream(message_generator(event_message_queue), metadata=metadata)
             self.active_rpcs.append(event_response_generator)
-        if "server_audio" in STREAMS:
-            server_audio_packet_generator = stub.ServerAudioStream(
-                comms_pb2.AudioStreamRequest(start=True), metadata=metadata
+        def open_audio_stream(resume_token="", resume_seq=0):
+            # with a resume token the server carries on with an interrupted clip from frame resume_seq
+            return stub.ServerAudioStream(
+                comms_pb2.AudioStreamRequest(
+                    start=True,
+                    frame_duration_us=AUDIO_FRAME_DURATION_US,
+                    frames_per_packet=AUDIO_FRAMES_PER_PACKET,
+                    resume_token=resume_token,
+                    resume_seq=resume_seq,
+                    preroll_frames=AUDIO_PREROLL_FRAMES,
+                ),
+                metadata=metadata,
             )
+
+        if "server_audio" in STREAMS:
+            server_audio_packet_generator = open_audio_stream()
             self.active_rpcs.append(server_audio_packet_generator)
 
+        # events sent and not acked yet, seq -> send time
+        events_in_flight = {}
+        event_window = threading.BoundedSemaphore(EVENT_WINDOW)
+        acks_done = threading.Event()
+
         def event_loop(event_queue):
+            seq = 0
             try:
                 while True:
                     button_event = event_queue.get()
@@ -302,18 +344,40 @@ class App(QWidget):
                             button_event=comms_pb2.ButtonEvent(
                                 button_id=button_event["button_id"],
                                 event=comms_pb2.ButtonEvent.ButtonEventType.PRESS,
-                            )
+                            ),
+                            seq=seq,
                         )
                     else:
                         print("Unknown event type:", button_event)
                         continue
+                    # only blocks when EVENT_WINDOW presses are waiting for their acks
+                    event_window.acquire()
+                    if acks_done.is_set():
+                        break
+                    events_in_flight[seq] = time.monotonic()
                     event_message_queue.put(event_message)
-                    server_response = next(event_response_generator)
-                    print("Event loop received:", server_response)
+                    seq += 1
+            except Exception as e:
+                print(f"Error in event loop: {e}")
+
+        def event_ack_loop():
+            try:
+                for server_response in event_response_generator:
+                    sent_at = events_in_flight.pop(server_response.seq, None)
+                    if sent_at is None:
+                        print("Ack for unknown event:", server_response)
+                        continue
+                    event_window.release()
+                    print(f"Event {server_response.seq} acked after {(time.monotonic() - sent_at) * 1000:.1f}ms")
             except grpc.RpcError as e:
                 print(f"RPC error in event loop: {e}")
             except Exception as e:
                 print(f"Error in event loop: {e}")
+            finally:
+                # no more acks are coming, let a sender waiting on the window see that
+                acks_done.set()
+                for _ in range(len(events_in_flight)):
+                    event_window.release()
 
         def status_loop():
             try:
@@ -328,56 +392,118 @@ class App(QWidget):
 
         def server_audio_loop():
             opus_coder = OpusCoder(sample_rate=48000, channels=1)
-            try:
-                f = None
-                num_packets = 0
-                for audio_packet in server_audio_packet_generator:
-                    print(
-                        "Server audio packet received: is_start",
-                        audio_packet.is_start,
-                        "is_end",
-                        audio_packet.is_end,
-                        "num_packets",
-                        num_packets,
-                    )
-                    if audio_packet.is_start:
-                        filename = f"audio_recordings/client/recording_{datetime.now().strftime('%Y%m%d_%H%M%S')}.wav"
-                        if f:
-                            f.close()
-                        f = wave.open(filename, "wb")
-                        f.setnchannels(1)
-                        f.setframerate(48000)
-                        f.setsampwidth(2)
-
-                    if f:
-                        f.writeframes(opus_coder.decode(bytearray(audio_packet.data)))
-
-                    if audio_packet.is_end:
-                        f.close()
-                        f = None
-                        print(f"Recording saved to {filename}")
-                        subprocess.run(["pw-play", filename])
-                        # pyaudio is broken on Linux
-                        # play_wav(filename)
-                        num_packets = 0
-                    num_packets += 1
 
-            except grpc.RpcError as e:
-                print(f"RPC error in server audio loop: {e}")
+            def decode(audio_packet):
+                # batched packets carry their frames in a repeated field, single frames in data
+                if audio_packet.frames:
+                    pcm = opus_coder.decode(list(audio_packet.frames))
+                else:
+                    pcm = opus_coder.decode(bytearray(audio_packet.data))
+                # an Ogg/Opus clip's encoder delay and end padding aren't played
+                return trim_pcm(pcm, audio_packet.skip_samples, audio_packet.trim_samples)
+
+            # audio plays from the jitter buffer as it arrives, recording to disk is optional
+            player = StreamingPlayer(make_sink(AUDIO_OUTPUT))
+            self.preroll = preroll = PrerollBuffer(player)
+            audio_packets = server_audio_packet_generator
+            # where to pick the current clip up if the stream drops, the token is cleared once the clip ends
+            resume_token = ""
+            next_seq = 0
+            reconnect_delay = AUDIO_RECONNECT_DELAY
+            f = None
+            num_packets = 0
+            try:
+                while True:
+                    try:
+                        for audio_packet in audio_packets:
+                            reconnect_delay = AUDIO_RECONNECT_DELAY
+                            print(
+                                "Server audio packet received: is_start",
+                                audio_packet.is_start,
+                                "is_end",
+                                audio_packet.is_end,
+                                "seq",
+                                audio_packet.seq,
+                                "num_packets",
+                                num_packets,
+                            )
+                            if audio_packet.provisional:
+                                # pre-roll of the mode just selected, held back until Play
+                                if audio_packet.is_start:
+                                    preroll.begin()
+                                if audio_packet.is_end:
+                                    preroll.discard()
+                                elif audio_packet.frames or audio_packet.data:
+                                    preroll.add(decode(audio_packet), audio_packet.seq + (len(audio_packet.frames) or 1))
+                                continue
+                            if not audio_packet.is_start and preroll.take(audio_packet.seq):
+                                # Play carried on from the pre-roll, which is already in the player
+                                next_seq = audio_packet.seq
+                            if audio_packet.resume_token:
+                                resume_token = audio_packet.resume_token
+                            if audio_packet.is_start:
+                                preroll.discard()
+                                next_seq = audio_packet.seq
+                                player.start_clip()
+                                if RECORD_AUDIO:
+                                    filename = f"audio_recordings/client/recording_{datetime.now().strftime('%Y%m%d_%H%M%S')}.wav"
+                                    if f:
+                                        f.close()
+                                    f = wave.open(filename, "wb")
+                                    f.setnchannels(1)
+                                    f.setframerate(48000)
+                                    f.setsampwidth(2)
+                            elif audio_packet.seq > next_seq and not audio_packet.is_end:
+                                print(f"Missed audio frames {next_seq} to {audio_packet.seq - 1}")
+
+                            if audio_packet.frames or audio_packet.data:
+                                pcm = decode(audio_packet)
+                                next_seq = audio_packet.seq + (len(audio_packet.frames) or 1)
+                            else:
+                                pcm = None
+                            if pcm is not None:
+                                player.write(pcm)
+                                if f:
+                                    f.writeframes(pcm)
+
+                            if audio_packet.is_end:
+                                player.end_clip()
+                                resume_token = ""
+                                if f:
+                                    f.close()
+                                    f = None
+                                    print(f"Recording saved to {filename}")
+                                num_packets = 0
+                            num_packets += 1
+                        break
+                    except grpc.RpcError as e:
+                        if e.code() == grpc.StatusCode.CANCELLED:
+                            # powered off or closed
+                            break
+                        print(f"RPC error in server audio loop: {e}, reconnecting in {reconnect_delay}s")
+                        time.sleep(reconnect_delay)
+                        reconnect_delay = min(AUDIO_RECONNECT_MAX_DELAY, reconnect_delay * 2)
+                        # only the frames we missed are sent again, not the whole clip
+                        audio_packets = open_audio_stream(resume_token, next_seq)
+                        self.active_rpcs.append(audio_packets)
             except Exception as e:
                 print(f"Error in server audio loop: {e}")
+            finally:
+                player.close()
 
 
         # Create and start daemon threads
         self.status_thread = threading.Thread(target=status_loop, daemon=True)
         self.event_thread = threading.Thread(target=event_loop, args=(self.event_queue,), daemon=True)
+        self.event_ack_thread = threading.Thread(target=event_ack_loop, daemon=True)
         self.server_audio_thread = threading.Thread(target=server_audio_loop, daemon=True)
         if "status" in STREAMS:
             self.status_thread.start()
             self.running_threads.append(self.status_thread)
         if "event" in STREAMS:
             self.event_thread.start()
-            self.running_threads.append(self.event_thread)
+            self.event_ack_thread.start()
+            self.running_threads.extend([self.event_thread, self.event_ack_thread])
         if "server_audio" in STREAMS:
             self.server_audio_thread.start()
             self.running_threads.append(self.server_audio_thread)
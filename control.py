@@ -0,0 +1,178 @@
+import asyncio
+import threading
+import time
+from collections import deque
+
+import metrics
+
+
+class AudioCommand():
+    '''
+    One transport command for a device's audio stream: "play", "stop", "mode" or "broadcast".
+    The audio stream also makes itself a "resume" command when a device reconnects in the middle of a clip.
+    posted_at is time.monotonic() when the button event was handled, used to measure press-to-first-packet latency.
+    start_time is the time.monotonic() a broadcast starts at, shared by every device in it.
+    remote is True for a command another replica handled and this one only mirrors.
+    '''
+    def __init__(self, kind, mode=None, start_time=None, remote=False):
+        self.kind = kind
+        self.mode = mode
+        self.start_time = start_time
+        self.remote = remote
+        self.posted_at = time.monotonic()
+
+    def __repr__(self):
+        return f"AudioCommand({self.kind!r}, mode={self.mode})"
+
+
+class ControlChannel():
+    '''
+    Small mailbox of AudioCommands from the event handlers to the device's audio stream, for the threaded server.
+
+    The audio stream blocks on a Condition until something is posted, an idle stream never wakes up.
+    While streaming it checks the mailbox with poll(), which is a deque check and never blocks.
+    '''
+    def __init__(self, maxlen=16):
+        # a device can't have more than a few meaningful presses outstanding, drop the oldest if it does
+        self._mailbox = deque(maxlen=maxlen)
+        self._cond = threading.Condition()
+
+    def post(self, kind, mode=None, start_time=None, remote=False):
+        with self._cond:
+            self._mailbox.append(AudioCommand(kind, mode, start_time, remote))
+            self._cond.notify_all()
+
+    def poll(self):
+        """Return the next command, or None without blocking."""
+        with self._cond:
+            return self._mailbox.popleft() if self._mailbox else None
+
+    def wait(self, timeout=None, cancelled=None):
+        """Block until a command is posted and return it, or None on timeout or once the cancelled Event is set."""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._mailbox or (cancelled is not None and cancelled.is_set()), timeout):
+                return None
+            return self._mailbox.popleft() if self._mailbox else None
+
+    def interrupt(self):
+        """Wake every waiter so the ones whose stream was cancelled can return."""
+        with self._cond:
+            self._cond.notify_all()
+
+    def drop_remote(self):
+        """Drop the queued commands mirrored from another replica, keep the device's own presses."""
+        with self._cond:
+            local = [command for command in self._mailbox if not command.remote]
+            self._mailbox.clear()
+            self._mailbox.extend(local)
+
+
+class AsyncControlChannel():
+    '''
+    ControlChannel for the grpc.aio server, post() and poll() are called from the event loop thread.
+    '''
+    def __init__(self, maxlen=16):
+        self._mailbox = deque(maxlen=maxlen)
+        self._posted = asyncio.Event()
+
+    def post(self, kind, mode=None, start_time=None, remote=False):
+        self._mailbox.append(AudioCommand(kind, mode, start_time, remote))
+        self._posted.set()
+
+    def poll(self):
+        """Return the next command, or None without waiting."""
+        if not self._mailbox:
+            return None
+        command = self._mailbox.popleft()
+        if not self._mailbox:
+            self._posted.clear()
+        return command
+
+    def drop_remote(self):
+        local = [command for command in self._mailbox if not command.remote]
+        self._mailbox.clear()
+        self._mailbox.extend(local)
+        if not self._mailbox:
+            self._posted.clear()
+
+    async def wait(self):
+        """Wait until a command is posted and return it."""
+        while not self._mailbox:
+            await self._posted.wait()
+        return self.poll()
+
+
+class StatusChannel():
+    '''
+    The LED state a device should show, for its StatusStream on the threaded server.
+
+    Only the latest desired state is kept, never a backlog: updates made while one is waiting to go out
+    are merged into it. wait() returns just the LEDs that differ from what the device was last sent.
+    '''
+    def __init__(self, leds):
+        self._desired = list(leds)
+        # nothing sent yet, a stream starts with take_all()
+        self._sent = None
+        self._cond = threading.Condition()
+
+    @property
+    def pending(self):
+        return self._desired != self._sent
+
+    def _update(self, leds):
+        if self._sent is not None and self.pending:
+            metrics.STATUS_COALESCED.inc()
+        self._desired = list(leds)
+
+    def _take(self):
+        changed = {index: led for index, led in enumerate(self._desired)
+                   if self._sent is None or led != self._sent[index]}
+        self._sent = list(self._desired)
+        return changed
+
+    def update(self, leds):
+        with self._cond:
+            self._update(leds)
+            self._cond.notify_all()
+
+    def take_all(self):
+        """Every LED as {index: rgba}, for a stream that just connected."""
+        with self._cond:
+            self._sent = list(self._desired)
+            return dict(enumerate(self._sent))
+
+    def wait(self, timeout=None, cancelled=None):
+        '''
+        Block until the LEDs differ from what was last sent and return the changed ones as {index: rgba}.
+        Returns None on timeout or once the cancelled Event is set.
+        '''
+        with self._cond:
+            self._cond.wait_for(lambda: self.pending or (cancelled is not None and cancelled.is_set()), timeout)
+            if not self.pending or (cancelled is not None and cancelled.is_set()):
+                return None
+            return self._take()
+
+    def interrupt(self):
+        """Wake every waiter so the ones whose stream was cancelled can return."""
+        with self._cond:
+            self._cond.notify_all()
+
+
+class AsyncStatusChannel(StatusChannel):
+    '''
+    StatusChannel for the grpc.aio server, update() and wait() are called from the event loop thread.
+    '''
+    def __init__(self, leds):
+        super().__init__(leds)
+        self._changed = asyncio.Event()
+
+    def update(self, leds):
+        self._update(leds)
+        self._changed.set()
+
+    async def wait(self):
+        """Wait until the LEDs differ from what was last sent and return the changed ones as {index: rgba}."""
+        while not self.pending:
+            self._changed.clear()
+            await self._changed.wait()
+        return self._take()
@@ -1,13 +1,30 @@
-import queue
-from google.protobuf import text_format
+import logging
 import comms_pb2
+from control import ControlChannel, StatusChannel
+
+logger = logging.getLogger(__name__)
+
+# clip played for each mode, index 0 is the startup sound
+AUDIO_FILENAMES = ["startup_mode.wav",
+                   "mode_1.wav",
+                   "mode_2.wav",
+                   "mode_3.wav",
+                   "mode_4.wav",
+                   "mode_5.wav"]
 
 class DeviceManager():
     '''
     map device status from the status stream to this class, and change the state in the instance of this class
     '''
-    def __init__(self):
-        self.device_id = None
+    def __init__(self, device_id=None, status_factory=StatusChannel, control_factory=ControlChannel, store=None,
+                 saved=None):
+        # status_factory is StatusChannel for the threaded server and AsyncStatusChannel for grpc.aio,
+        # the handlers only call update() so they work with either.
+        # control_factory is ControlChannel or AsyncControlChannel, the same split for play/stop/mode commands
+        # store is a state_store.StateStore, mode and LEDs are saved there so another replica can pick the device up.
+        # saved is what the store had for the device, read by the SessionRegistry before the session is built
+        self.device_id = device_id
+        self.store = store
         self.state = None
         self.leds = [0x00000000
                      ,0x00000000
@@ -15,17 +32,40 @@ class DeviceManager():
                      ,0x00000000
                      ,0x00000000
                      ,0x00000000]
-        self.audio_event_queue = queue.Queue()
-        self.status_queue = queue.Queue()
+        # play/stop/mode commands for this device's audio stream
+        self.control = control_factory()
         self.mode = 0
         self.recording = False
-        self.audio_filenames = ["startup_mode.wav",
-                                 "mode_1.wav", 
-                                 "mode_2.wav", 
-                                 "mode_3.wav", 
-                                 "mode_4.wav", 
-                                 "mode_5.wav"]
+        self.audio_filenames = AUDIO_FILENAMES
         self.stream = None
+        if saved:
+            self.mode = saved["mode"]
+            self.leds = list(saved["leds"])
+            logger.debug("Restored device %s in mode %d", device_id, self.mode)
+        # latest LED state for the status stream, pending updates are merged instead of queued
+        self.status = status_factory(self.leds)
+
+    def snapshot(self):
+        return {"mode": self.mode, "leds": list(self.leds)}
+
+    def persist(self, kind):
+        """Save the current mode and LEDs and tell the other replicas about the command."""
+        if self.store is None:
+            return
+        state = self.snapshot()
+        self.store.save(self.device_id, state)
+        self.store.publish(self.device_id, kind, state)
+
+    def apply_remote(self, kind, state):
+        """Apply a play/mode/stop command that another replica handled for this device."""
+        self.mode = state["mode"]
+        self.leds = list(state["leds"])
+        self.status.update(self.leds)
+        if kind == "stop":
+            self.control.post("stop", remote=True)
+        else:
+            self.control.post(kind, self.mode, remote=True)
+        logger.debug("Device %s applied remote %s command, mode %d", self.device_id, kind, self.mode)
 
     def device_status_set(self, leds):
         """Create a DeviceStatusSet message from a list of LED values."""
@@ -38,11 +78,18 @@ class DeviceManager():
             led_5=comms_pb2.RGBAColor(rgba=leds[5])
         )
 
+    def status_request(self, changed):
+        """DeviceStatusRequest setting only the LEDs in changed, {index: rgba}. The device keeps the others as they are."""
+        return comms_pb2.DeviceStatusRequest(set=comms_pb2.DeviceStatusSet(
+            **{f"led_{index}": comms_pb2.RGBAColor(rgba=rgba) for index, rgba in changed.items()}))
+
     def handle_play_event(self, event):
-        status_set = self.device_status_set(self.leds)
-        self.status_queue.put(comms_pb2.DeviceStatusRequest(set=status_set))
-        self.audio_event_queue.put({"play": True})
-        print(f"DeviceManager handled mode event {repr(event)}, set device state to {text_format.MessageToString(status_set)}")
+        # Play doesn't change the LEDs, this only sends something if an earlier update is still pending
+        self.status.update(self.leds)
+        self.control.post("play", self.mode)
+        self.persist("play")
+        # logged lazily, formatting protobufs on every press costs more than handling it
+        logger.debug("DeviceManager handled play event %r, LEDs %s", event, self.leds)
 
     def handle_mode_event(self, event):
         # Ignore LED 0, cycle through LEDs 1-5
@@ -61,30 +108,31 @@ class DeviceManager():
         next_led = 1 if active_led == 5 or active_led == -1 else active_led + 1
         self.leds[next_led] = 0xFF00FFFF  # Magenta color
         self.mode = next_led
-        print(f"Device is in mode {self.mode}")
-        
-        print(f"LED {next_led} is now on: {hex(self.leds[next_led])}")
-        status_set = self.device_status_set(self.leds)
-        self.status_queue.put(comms_pb2.DeviceStatusRequest(set=status_set))
-        print(f"DeviceManager handled mode event {repr(event)}, set device state to {text_format.MessageToString(status_set)}")
+        logger.debug("Device %s is in mode %d", self.device_id, self.mode)
+
+        logger.debug("LED %d is now on: %#x", next_led, self.leds[next_led])
+        self.status.update(self.leds)
+        self.control.post("mode", self.mode)
+        self.persist("mode")
+        logger.debug("DeviceManager handled mode event %r, LEDs %s", event, self.leds)
 
     def handle_stop_event(self, event):
         # Set all LEDs to off (0x00000000)
         self.leds = [0x00000000, 0x00000000, 0x00000000, 0x00000000, 0x00000000, 0x00000000]
-        print(f"All LEDs turned off")
-        status_set = self.device_status_set(self.leds)
+        logger.debug("All LEDs turned off")
         self.mode = 0
-        self.audio_event_queue.put({"play": False})
-        self.status_queue.put(comms_pb2.DeviceStatusRequest(set=status_set))
-        print(f"DeviceManager handled stop event {repr(event)}, set device state to {text_format.MessageToString(status_set)}")
+        self.control.post("stop")
+        self.status.update(self.leds)
+        self.persist("stop")
+        logger.debug("DeviceManager handled stop event %r, LEDs %s", event, self.leds)
 
     def handle_power_event(self, event):
-        print(f"DeviceManager handled power event {repr(event)}")
+        logger.debug("DeviceManager handled power event %r", event)
 
     def handle_status_request(self, request, context):
         if request.kind() == "get":
-            print("Get Device status")
+            logger.debug("Get Device status")
             return request
         elif request.kind() == "set":
-            print("Set Device status")
+            logger.debug("Set Device status")
             return request.set
\ No newline at end of file
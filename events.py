@@ -0,0 +1,78 @@
+'''
+Button events are handled off the EventStream: the stream queues each event and acks it straight away
+with its seq, and a worker runs the DeviceManager handler. A device can have several presses in flight
+instead of waiting a round trip and a handler per press.
+'''
+import logging
+import queue
+import threading
+
+import comms_pb2
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def handle_event(device_manager, request):
+    """Run the DeviceManager handler for one DeviceEvent."""
+    button_id = request.button_event.button_id
+    metrics.EVENTS.inc(button=comms_pb2.ButtonEvent.ButtonId.Name(button_id))
+    if button_id == comms_pb2.ButtonEvent.ButtonId.BUTTON_2:
+        device_manager.handle_mode_event(request)
+    elif button_id == comms_pb2.ButtonEvent.ButtonId.BUTTON_4:
+        device_manager.handle_play_event(request)
+    elif button_id == comms_pb2.ButtonEvent.ButtonId.BUTTON_3:
+        device_manager.handle_stop_event(request)
+
+
+class EventDispatcher():
+    '''
+    Worker threads for the threaded server's button events.
+
+    Each device always goes to the same worker, so its events are handled in the order they were sent,
+    while other devices' events run on the other workers. The queues are bounded: a device pressing
+    faster than its events are handled blocks in submit(), which holds back its acks.
+    '''
+    def __init__(self, workers=4, maxsize=256):
+        self._queues = [queue.Queue(maxsize) for _ in range(workers)]
+        self._threads = []
+        for index, events in enumerate(self._queues):
+            thread = threading.Thread(target=self._run, args=(events,), name=f"events-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, device_manager, request):
+        self._queues[hash(device_manager.device_id) % len(self._queues)].put((device_manager, request))
+
+    def pending(self):
+        return sum(events.qsize() for events in self._queues)
+
+    def close(self):
+        """Handle what is already queued, then stop the workers."""
+        for events in self._queues:
+            events.put(None)
+        for thread in self._threads:
+            thread.join(timeout=1.0)
+
+    def _run(self, events):
+        while True:
+            item = events.get()
+            if item is None:
+                return
+            device_manager, request = item
+            try:
+                handle_event(device_manager, request)
+            except Exception:
+                logger.exception("error handling event %d from %s", request.seq, device_manager.device_id)
+
+
+async def run_events(events, device_manager):
+    """Worker task for one grpc.aio EventStream, handles events from an asyncio.Queue until a None."""
+    while True:
+        request = await events.get()
+        if request is None:
+            return
+        try:
+            handle_event(device_manager, request)
+        except Exception:
+            logger.exception("error handling event %d from %s", request.seq, device_manager.device_id)
@@ -0,0 +1,199 @@
+'''
+Microphone uploads: Opus packets a device sends on ClientAudioStream are decoded and written to disk
+as rotating WAV segments. Each stream holds one fixed flush buffer, so memory per stream stays the same
+however long the device records, and the disk sees a few large sequential writes instead of one per frame.
+'''
+import asyncio
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+import wave
+from collections import deque
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def safe_name(device_id):
+    """device_id comes from client metadata, keep it to one harmless path component."""
+    # no leading dots either, ".." would climb out of the recordings directory
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", device_id).lstrip(".") or "unknown"
+
+
+class SegmentWriter():
+    '''
+    Appends 16 bit PCM to a series of WAV files under directory.
+
+    Writes are copied into a buffer of flush_bytes allocated once, and go to the current segment in
+    one writeframes when it fills. A segment is closed and the next one opened after segment_seconds of audio.
+    '''
+    def __init__(self, directory, prefix, sample_rate=48000, channels=1, segment_seconds=300, flush_bytes=256 * 1024):
+        self.directory = directory
+        self.prefix = prefix
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.frame_bytes = 2 * channels
+        # whole sample frames only, so a flush never splits one
+        self.segment_bytes = int(segment_seconds * sample_rate) * self.frame_bytes
+        self._buffer = bytearray(flush_bytes - flush_bytes % self.frame_bytes)
+        self._view = memoryview(self._buffer)
+        self._zeros = memoryview(bytes(len(self._buffer)))
+        self._fill = 0
+        self._wav = None
+        self._segment_written = 0
+        self.paths = []
+        self.bytes_written = 0
+
+    def write(self, pcm):
+        pcm = memoryview(pcm).cast("B")
+        while len(pcm):
+            count = min(len(pcm), len(self._buffer) - self._fill)
+            self._view[self._fill:self._fill + count] = pcm[:count]
+            self._fill += count
+            pcm = pcm[count:]
+            if self._fill == len(self._buffer):
+                self.flush()
+
+    def write_silence(self, nbytes):
+        """Fill a gap in the upload so the recording keeps its timing."""
+        while nbytes > 0:
+            count = min(nbytes, len(self._zeros))
+            self.write(self._zeros[:count])
+            nbytes -= count
+
+    def flush(self):
+        data = self._view[:self._fill]
+        while len(data):
+            if self._wav is None:
+                self._open_segment()
+            count = min(len(data), self.segment_bytes - self._segment_written)
+            self._wav.writeframes(data[:count])
+            self._segment_written += count
+            self.bytes_written += count
+            metrics.INGEST_BYTES.inc(count)
+            data = data[count:]
+            if self._segment_written >= self.segment_bytes:
+                self._close_segment()
+        self._fill = 0
+
+    def close(self):
+        self.flush()
+        self._close_segment()
+
+    def _open_segment(self):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{self.prefix}_{len(self.paths):04d}.wav")
+        self._wav = wave.open(path, "wb")
+        self._wav.setnchannels(self.channels)
+        self._wav.setsampwidth(2)
+        self._wav.setframerate(self.sample_rate)
+        self._segment_written = 0
+        self.paths.append(path)
+        metrics.INGEST_SEGMENTS.inc()
+        logger.debug("opened segment %s", path)
+
+    def _close_segment(self):
+        if self._wav is not None:
+            self._wav.close()
+            self._wav = None
+
+
+class Recorder():
+    '''
+    Turns one device's ClientAudioStream into recordings. is_start begins a new recording in its own set of
+    segments, is_end closes it. Frames missing from the seq numbering are written as silence, up to max_gap_seconds.
+    '''
+    def __init__(self, opus_decoder, directory, device_id, sample_rate=48000, channels=1,
+                 segment_seconds=300, max_gap_seconds=5):
+        self.opus_decoder = opus_decoder
+        self.directory = os.path.join(directory, safe_name(device_id))
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.segment_seconds = segment_seconds
+        self.max_gap_bytes = int(max_gap_seconds * sample_rate) * 2 * channels
+        self.writer = None
+        self.next_seq = None
+        self.frame_bytes = 0
+        self.packets = 0
+        self.missed_frames = 0
+        self.segments = 0
+
+    def packet(self, packet):
+        self.packets += 1
+        if packet.is_start or self.writer is None:
+            self.finish()
+            prefix = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+            self.writer = SegmentWriter(self.directory, prefix, self.sample_rate, self.channels, self.segment_seconds)
+            self.next_seq = packet.seq
+        frames = list(packet.frames) if packet.frames else ([packet.data] if packet.data else [])
+        if packet.seq > self.next_seq and self.frame_bytes:
+            missed = packet.seq - self.next_seq
+            self.missed_frames += missed
+            metrics.INGEST_MISSED_FRAMES.inc(missed)
+            self.writer.write_silence(min(missed * self.frame_bytes, self.max_gap_bytes))
+        for frame in frames:
+            # the decoder returns a view of its own buffer, it is copied out before the next decode
+            pcm = self.opus_decoder.decode(bytearray(frame))
+            self.frame_bytes = len(pcm)
+            self.writer.write(pcm)
+        self.next_seq = max(self.next_seq, packet.seq + len(frames))
+        if packet.is_end:
+            self.finish()
+
+    def finish(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.segments += len(self.writer.paths)
+            logger.info("recorded %d bytes to %s", self.writer.bytes_written, ", ".join(self.writer.paths) or "nothing")
+            self.writer = None
+
+
+class AsyncRecorder():
+    '''
+    A Recorder for the grpc.aio server. Packets are queued on the loop and one executor job at a time
+    decodes and writes them, draining whatever queued up meanwhile, so neither Opus decoding nor disk
+    writes run on the loop and a busy stream costs one executor hop per batch rather than one per packet.
+    When max_pending packets are waiting the disk is behind and packet() waits for it.
+    '''
+    def __init__(self, recorder, max_pending=50):
+        self.recorder = recorder
+        self.max_pending = max_pending
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._running = False
+        self._job = None
+
+    async def packet(self, packet):
+        with self._lock:
+            self._pending.append(packet)
+            idle = not self._running
+            self._running = True
+        if idle:
+            if self._job is not None:
+                # it has already seen an empty queue and is on its way out
+                await self._job
+            self._job = asyncio.get_running_loop().run_in_executor(None, self._drain)
+        elif self._job.done() or len(self._pending) >= self.max_pending:
+            # done while still marked running means it raised, awaiting it passes the error on
+            await self._job
+
+    async def finish(self):
+        """Wait for the queued packets to be written, then close the recording."""
+        try:
+            if self._job is not None:
+                await self._job
+        finally:
+            await asyncio.get_running_loop().run_in_executor(None, self.recorder.finish)
+
+    def _drain(self):
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._running = False
+                    return
+                packet = self._pending.popleft()
+            self.recorder.packet(packet)
@@ -0,0 +1,392 @@
+'''
+Headless load generator for the device server.
+
+Simulates N devices, each with its own device_id, channel and the same three streams client.py opens,
+presses Mode/Play/Stop from a weighted mix and measures how the server keeps up. Results are printed
+and written as JSON so runs against different builds can be compared.
+
+    python load_test.py --devices 50 --duration 60 --server-pid $(pgrep -f server.py) --output results.json
+
+--mic plays a WAV file into ClientAudioStream from every device, to load the upload path as well.
+'''
+import argparse
+import json
+import os
+import queue
+import random
+import threading
+import time
+
+import grpc
+
+import comms_pb2, comms_pb2_grpc
+from audio import OpusCoder, encode_wav
+
+BUTTONS = {
+    "mode": comms_pb2.ButtonEvent.ButtonId.BUTTON_2,
+    "play": comms_pb2.ButtonEvent.ButtonId.BUTTON_4,
+    "stop": comms_pb2.ButtonEvent.ButtonId.BUTTON_3,
+}
+
+
+def message_generator(message_queue):
+    # same as client.py, a None on the queue ends the request stream
+    while True:
+        message = message_queue.get()
+        if message is None:
+            return
+        yield message
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(values):
+    return {
+        "count": len(values),
+        "p50": percentile(values, 0.50),
+        "p99": percentile(values, 0.99),
+        "max": max(values) if values else None,
+    }
+
+
+def process_cpu_seconds(pid):
+    """utime + stime of a local process from /proc, None if it can't be read."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        # fields[11] and [12] are utime and stime once pid and comm are stripped
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+class FileMicSource():
+    '''
+    Stands in for a device microphone: a 48kHz mono WAV is encoded to Opus once, and every upload
+    sends all of it as one recording at real time, the way a device would capture it.
+    '''
+    def __init__(self, file_path, frame_duration=20/1000):
+        self.frame_duration = frame_duration
+        self.frames = encode_wav(file_path, OpusCoder(sample_rate=48000, channels=1), frame_duration)
+
+    def packets(self, stopping):
+        """AudioPackets for one recording, ended early if stopping is set."""
+        started = time.monotonic()
+        seq = 0
+        for seq, frame in enumerate(self.frames):
+            if stopping.wait(max(0, started + seq * self.frame_duration - time.monotonic())):
+                break
+            yield comms_pb2.AudioPacket(is_start=seq == 0, data=frame, seq=seq,
+                                        timestamp_us=round(seq * self.frame_duration * 1_000_000))
+        else:
+            seq = len(self.frames)
+        yield comms_pb2.AudioPacket(is_end=True, seq=seq)
+
+
+class SimulatedDevice():
+    '''
+    One headless device: the status, event and audio streams from client.setup_client without the Qt UI.
+    With a mic source it also uploads recordings on ClientAudioStream, one after another with interval between them.
+    '''
+    def __init__(self, device_id, target, mix, interval, frame_duration_us, frames_per_packet, verify, mic=None,
+                 preroll_frames=0):
+        self.device_id = device_id
+        self.target = target
+        self.mix = mix
+        self.interval = interval
+        self.frame_duration_us = frame_duration_us or 20000
+        self.frames_per_packet = frames_per_packet or 1
+        self.verify = verify
+        self.mic = mic
+        self.preroll_frames = preroll_frames
+        self.channel = None
+        self.threads = []
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.pending_play = None
+        self.pending_stop = None
+        self.playing = False
+        # results
+        self.ack_latencies = []
+        self.play_latencies = []
+        self.stop_latencies = []
+        self.start_times = []
+        self.packets = 0
+        self.bytes = 0
+        self.bad_packets = 0
+        # provisional packets received, and plays that carried on from their pre-roll
+        self.provisional_packets = 0
+        self.preroll_plays = 0
+        self.uploads = 0
+        self.upload_missed_frames = 0
+        self.errors = []
+
+    def start(self):
+        self.channel = grpc.insecure_channel(self.target)
+        stub = comms_pb2_grpc.DeviceServiceStub(self.channel)
+        metadata = [("device_id", self.device_id)]
+        self.status_queue = queue.Queue()
+        self.event_queue = queue.Queue()
+        self.status_responses = stub.StatusStream(message_generator(self.status_queue), metadata=metadata)
+        self.event_responses = stub.EventStream(message_generator(self.event_queue), metadata=metadata)
+        self.audio_packets = stub.ServerAudioStream(
+            comms_pb2.AudioStreamRequest(
+                start=True, frame_duration_us=self.frame_duration_us, frames_per_packet=self.frames_per_packet,
+                preroll_frames=self.preroll_frames),
+            metadata=metadata)
+        self.stub = stub
+        self.metadata = metadata
+        loops = [self.status_loop, self.event_loop, self.audio_loop] + ([self.mic_loop] if self.mic else [])
+        for target in loops:
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.stopping.set()
+        for rpc in (self.status_responses, self.event_responses, self.audio_packets):
+            rpc.cancel()
+        self.status_queue.put(None)
+        self.event_queue.put(None)
+        for thread in self.threads:
+            thread.join(timeout=2.0)
+        self.channel.close()
+
+    def status_loop(self):
+        try:
+            for request in self.status_responses:
+                # the simulator has no LEDs, just ack every SET the way the client does
+                self.status_queue.put(comms_pb2.DeviceStatusResponse(status="success"))
+        except grpc.RpcError as e:
+            if not self.stopping.is_set():
+                self.errors.append(f"status: {e.code()}")
+
+    def event_loop(self):
+        names = list(self.mix)
+        weights = [self.mix[name] for name in names]
+        seq = 0
+        try:
+            while not self.stopping.is_set():
+                name = random.choices(names, weights)[0]
+                sent_at = time.monotonic()
+                with self.lock:
+                    if name == "play":
+                        self.pending_play = sent_at
+                    elif name == "stop" and self.playing:
+                        self.pending_stop = sent_at
+                self.event_queue.put(comms_pb2.DeviceEvent(
+                    button_event=comms_pb2.ButtonEvent(
+                        button_id=BUTTONS[name], event=comms_pb2.ButtonEvent.ButtonEventType.PRESS),
+                    seq=seq))
+                # presses are interval apart, one in flight at a time measures the ack round trip
+                ack = next(self.event_responses)
+                self.ack_latencies.append(time.monotonic() - sent_at)
+                if ack.seq != seq:
+                    self.errors.append(f"event: ack for {ack.seq}, expected {seq}")
+                seq += 1
+                # jitter so the devices don't press in lockstep
+                self.stopping.wait(self.interval * random.uniform(0.5, 1.5))
+        except (grpc.RpcError, StopIteration) as e:
+            if not self.stopping.is_set():
+                self.errors.append(f"event: {e}")
+
+    def audio_loop(self):
+        opus_coder = OpusCoder(sample_rate=48000, channels=1) if self.verify else None
+        expected_pcm_bytes = 48000 * self.frame_duration_us // 1_000_000 * 2
+        # seq a play continuing the pre-roll starts at, None when there is no pre-roll held
+        preroll_next = None
+        try:
+            for packet in self.audio_packets:
+                now = time.monotonic()
+                frames = list(packet.frames) if packet.frames else ([packet.data] if packet.data else [])
+                if packet.provisional:
+                    self.provisional_packets += 1
+                    if packet.is_start:
+                        preroll_next = 0
+                    if packet.is_end:
+                        preroll_next = None
+                    elif preroll_next is not None:
+                        preroll_next = packet.seq + len(frames)
+                    continue
+                continues = not packet.is_start and packet.seq == preroll_next
+                preroll_next = None
+                if continues:
+                    self.preroll_plays += 1
+                with self.lock:
+                    if packet.is_start or continues:
+                        self.playing = True
+                        self.start_times.append(now)
+                        if self.pending_play is not None:
+                            self.play_latencies.append(now - self.pending_play)
+                            self.pending_play = None
+                    if packet.is_end:
+                        self.playing = False
+                        if self.pending_stop is not None:
+                            self.stop_latencies.append(now - self.pending_stop)
+                            self.pending_stop = None
+                self.packets += 1
+                self.bytes += sum(len(frame) for frame in frames)
+                if opus_coder:
+                    for frame in frames:
+                        try:
+                            if len(opus_coder.decode(bytearray(frame))) != expected_pcm_bytes:
+                                self.bad_packets += 1
+                        except Exception:
+                            self.bad_packets += 1
+        except grpc.RpcError as e:
+            if not self.stopping.is_set():
+                self.errors.append(f"audio: {e.code()}")
+
+
+    def mic_loop(self):
+        try:
+            while not self.stopping.is_set():
+                # the upload ends itself once stopping is set, so the call always returns
+                response = self.stub.ClientAudioStream(self.mic.packets(self.stopping), metadata=self.metadata)
+                self.uploads += 1
+                self.upload_missed_frames += response.missed_frames
+                self.stopping.wait(self.interval * random.uniform(0.5, 1.5))
+        except grpc.RpcError as e:
+            if not self.stopping.is_set():
+                self.errors.append(f"mic: {e.code()}")
+
+
+def parse_mix(text):
+    """'mode=2,play=1,stop=1' -> {'mode': 2.0, 'play': 1.0, 'stop': 1.0}"""
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name not in BUTTONS:
+            raise argparse.ArgumentTypeError(f"unknown button {name!r}, expected one of {sorted(BUTTONS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def broadcast_loop(target, mode, every, stopping, sent_times, errors):
+    """Ask the server to play mode on every connected device every `every` seconds."""
+    with grpc.insecure_channel(target) as channel:
+        stub = comms_pb2_grpc.DeviceServiceStub(channel)
+        while not stopping.wait(every):
+            try:
+                sent_times.append(time.monotonic())
+                stub.Broadcast(comms_pb2.BroadcastRequest(mode=mode))
+            except grpc.RpcError as e:
+                errors.append(f"broadcast: {e.code()}")
+
+
+def broadcast_skew(sent_times, devices):
+    """For each broadcast, the spread between the first and last device to receive its first packet."""
+    skews = []
+    for index, sent in enumerate(sent_times):
+        until = sent_times[index + 1] if index + 1 < len(sent_times) else float("inf")
+        firsts = [next((t for t in d.start_times if sent <= t < until), None) for d in devices]
+        firsts = [t for t in firsts if t is not None]
+        if len(firsts) > 1:
+            skews.append(max(firsts) - min(firsts))
+    return skews
+
+
+def run(args):
+    random.seed(args.seed)
+    mic = FileMicSource(args.mic) if args.mic else None
+    devices = [
+        SimulatedDevice(f"{args.device_prefix}{i}", args.target, args.mix, args.interval,
+                        args.frame_duration_us, args.frames_per_packet, args.verify, mic, args.preroll_frames)
+        for i in range(args.devices)
+    ]
+    cpu_start = process_cpu_seconds(args.server_pid) if args.server_pid else None
+    started = time.monotonic()
+    for device in devices:
+        device.start()
+        # stagger connects a little instead of opening every channel at once
+        time.sleep(args.ramp / max(1, args.devices))
+    broadcast_stopping = threading.Event()
+    broadcast_times = []
+    broadcast_errors = []
+    if args.broadcast_every:
+        threading.Thread(target=broadcast_loop, daemon=True, args=(
+            args.target, args.broadcast_mode, args.broadcast_every,
+            broadcast_stopping, broadcast_times, broadcast_errors)).start()
+    time.sleep(args.duration)
+    broadcast_stopping.set()
+    elapsed = time.monotonic() - started
+    cpu_end = process_cpu_seconds(args.server_pid) if args.server_pid else None
+    for device in devices:
+        device.stop()
+
+    packets = sum(device.packets for device in devices)
+    results = {
+        "label": args.label,
+        "config": {
+            "target": args.target,
+            "devices": args.devices,
+            "duration": args.duration,
+            "mix": args.mix,
+            "interval": args.interval,
+            "frame_duration_us": args.frame_duration_us,
+            "frames_per_packet": args.frames_per_packet,
+            "broadcast_every": args.broadcast_every,
+            "mic": args.mic,
+            "preroll_frames": args.preroll_frames,
+        },
+        "elapsed": elapsed,
+        "button_to_ack": summarize([x for d in devices for x in d.ack_latencies]),
+        "play_to_first_packet": summarize([x for d in devices for x in d.play_latencies]),
+        "stop_to_last_packet": summarize([x for d in devices for x in d.stop_latencies]),
+        "packets": packets,
+        "packets_per_second": packets / elapsed,
+        "bytes": sum(device.bytes for device in devices),
+        "bad_packets": sum(device.bad_packets for device in devices),
+        "provisional_packets": sum(device.provisional_packets for device in devices),
+        "preroll_plays": sum(device.preroll_plays for device in devices),
+        "broadcasts": len(broadcast_times),
+        "broadcast_start_skew": summarize(broadcast_skew(broadcast_times, devices)),
+        "uploads": sum(device.uploads for device in devices),
+        "upload_missed_frames": sum(device.upload_missed_frames for device in devices),
+        "errors": [f"{d.device_id} {e}" for d in devices for e in d.errors] + broadcast_errors,
+        "server_cpu_percent": (100 * (cpu_end - cpu_start) / elapsed
+                               if cpu_start is not None and cpu_end is not None else None),
+    }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless multi-device load test for the device server")
+    parser.add_argument("--target", default="localhost:50051")
+    parser.add_argument("--devices", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds to run after all devices connect")
+    parser.add_argument("--ramp", type=float, default=1.0, help="seconds over which devices connect")
+    parser.add_argument("--interval", type=float, default=2.0, help="mean seconds between button presses per device")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("mode=2,play=1,stop=1"),
+                        help="weighted button mix, e.g. mode=2,play=1,stop=1")
+    parser.add_argument("--frame-duration-us", type=int, default=0)
+    parser.add_argument("--frames-per-packet", type=int, default=0)
+    parser.add_argument("--preroll-frames", type=int, default=0,
+                        help="ask for this many frames of the selected clip ahead of Play on every Mode press")
+    parser.add_argument("--broadcast-every", type=float, default=0,
+                        help="also broadcast a clip to every device this often, in seconds")
+    parser.add_argument("--broadcast-mode", type=int, default=1, help="mode clip to broadcast")
+    parser.add_argument("--mic", default=None,
+                        help="48kHz mono WAV each device uploads on ClientAudioStream, e.g. mode_1.wav")
+    parser.add_argument("--no-verify", dest="verify", action="store_false", help="don't decode received Opus frames")
+    parser.add_argument("--server-pid", type=int, default=None, help="local server pid to sample CPU time from")
+    parser.add_argument("--device-prefix", default="load_")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--label", default="", help="free text stored with the results, e.g. a commit id")
+    parser.add_argument("--output", default=None, help="write JSON results to this file")
+    args = parser.parse_args()
+
+    results = run(args)
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
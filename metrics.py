@@ -0,0 +1,215 @@
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# every metric registers itself here so render() can expose them all
+REGISTRY = []
+
+
+def format_labels(labelnames, values):
+    if not labelnames:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labelnames, values)) + "}"
+
+
+class Counter():
+    '''
+    Monotonic counter, optionally split by labels: Counter("x_total", "...", ["rpc"]).inc(rpc="EventStream")
+    '''
+    kind = "counter"
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(labels[name] for name in self.labelnames), 0)
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in values:
+            lines.append(f"{self.name}{format_labels(self.labelnames, key)} {value}")
+        return "\n".join(lines)
+
+
+class Gauge(Counter):
+    '''
+    Value that goes up and down. With function set, the value is read from it at scrape time instead,
+    which is how queue depths are reported without touching the hot path at all.
+    '''
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labelnames=(), function=None):
+        super().__init__(name, help_text, labelnames)
+        self.function = function
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = value
+
+    def render(self):
+        if self.function is not None:
+            try:
+                self.set(self.function())
+            except Exception:
+                logger.exception("error reading gauge %s", self.name)
+        return super().render()
+
+
+class Histogram():
+    '''
+    Prometheus style cumulative histogram, observe() is cheap enough for the streaming path.
+    '''
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = sorted(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def render(self):
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        cumulative += counts[-1]
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {cumulative}')
+        lines.append(f"{self.name}_sum {total}")
+        lines.append(f"{self.name}_count {cumulative}")
+        return "\n".join(lines)
+
+
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5]
+
+PLAY_TO_FIRST_PACKET = Histogram(
+    "device_play_to_first_packet_seconds",
+    "Time from handling a Play press to yielding the first audio packet",
+    LATENCY_BUCKETS)
+STOP_TO_LAST_PACKET = Histogram(
+    "device_stop_to_last_packet_seconds",
+    "Time from handling a Stop press to yielding the end packet of the interrupted clip",
+    LATENCY_BUCKETS)
+ENCODE_SECONDS = Histogram(
+    "device_opus_encode_seconds",
+    "Time to encode one Opus frame",
+    [0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01])
+PACING_LAG = Histogram(
+    "device_audio_pacing_lag_seconds",
+    "How late each audio packet went out after its release time on the media clock",
+    LATENCY_BUCKETS)
+BITRATE_SWITCHES = Counter(
+    "device_audio_bitrate_switches_total",
+    "Bitrate ladder steps taken by audio streams, by direction",
+    ["direction"])
+ACTIVE_STREAMS = Gauge(
+    "device_active_streams",
+    "Streaming RPCs currently open, by RPC",
+    ["rpc"])
+THREADS = Gauge(
+    "device_server_threads",
+    "Threads alive in the server process")
+SESSIONS = Gauge(
+    "device_sessions",
+    "Device sessions held in the session registry")
+EVENTS = Counter(
+    "device_events_total",
+    "Button events received from devices, by button",
+    ["button"])
+PACKETS_SENT = Counter(
+    "device_audio_packets_sent_total",
+    "AudioPackets yielded to devices")
+BYTES_SENT = Counter(
+    "device_audio_bytes_sent_total",
+    "Opus payload bytes yielded to devices")
+PREROLLS = Counter(
+    "device_audio_prerolls_total",
+    "Provisional pre-rolls sent on a Mode press, by whether a Play used them or they were discarded",
+    ["outcome"])
+BROADCASTS = Gauge(
+    "device_broadcasts",
+    "Broadcast producers currently releasing packets")
+BROADCAST_SUBSCRIBERS = Gauge(
+    "device_broadcast_subscribers",
+    "Audio streams subscribed to a broadcast")
+BROADCAST_DROPPED = Counter(
+    "device_broadcast_packets_dropped_total",
+    "Broadcast packets dropped because a subscriber's queue was full")
+INGEST_BYTES = Counter(
+    "device_ingest_bytes_written_total",
+    "Decoded PCM bytes written to recording segments")
+INGEST_SEGMENTS = Counter(
+    "device_ingest_segments_total",
+    "Recording segment files opened")
+INGEST_MISSED_FRAMES = Counter(
+    "device_ingest_missed_frames_total",
+    "Uploaded Opus frames missing from the seq numbering")
+EVENT_QUEUE_DEPTH = Gauge(
+    "device_event_queue_depth",
+    "Button events acked and waiting for a worker")
+STATUS_PENDING = Gauge(
+    "device_status_pending",
+    "Sessions with an LED update waiting to be sent")
+STATUS_COALESCED = Counter(
+    "device_status_coalesced_total",
+    "LED updates merged into one that had not been sent yet")
+
+
+def render():
+    """Text exposition of every registered metric."""
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes every few seconds would flood stdout
+        pass
+
+
+def start_http_server(port):
+    """Serve /metrics on a daemon thread."""
+    server = ThreadingHTTPServer(("", port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True)
+    thread.start()
+    logger.info("Metrics available on :%s/metrics", port)
+    return server
@@ -0,0 +1,126 @@
+'''
+Demuxer for Ogg/Opus files (what opusenc writes), so pre-encoded assets can be streamed
+packet for packet without decoding and re-encoding them.
+'''
+import struct
+
+OGG_PAGE_HEADER = struct.Struct("<4sBBqIIIB")
+
+# samples per frame at 48kHz for each TOC config, RFC 6716 section 3.1
+SILK_FRAME_SIZES = (480, 960, 1920, 2880)
+HYBRID_FRAME_SIZES = (480, 960)
+CELT_FRAME_SIZES = (120, 240, 480, 960)
+
+
+def packet_samples(packet):
+    """Number of 48kHz samples an Opus packet decodes to, read from its TOC byte."""
+    toc = packet[0]
+    config = toc >> 3
+    if config < 12:
+        frame_size = SILK_FRAME_SIZES[config % 4]
+    elif config < 16:
+        frame_size = HYBRID_FRAME_SIZES[config % 2]
+    else:
+        frame_size = CELT_FRAME_SIZES[config % 4]
+    code = toc & 0x03
+    if code == 0:
+        frames = 1
+    elif code in (1, 2):
+        frames = 2
+    else:
+        frames = packet[1] & 0x3F
+    return frame_size * frames
+
+
+def read_ogg_packets(data):
+    """Yield (packet, page granule position or -1 if the packet doesn't end the page) for one logical stream."""
+    position = 0
+    partial = b""
+    serial = None
+    while position + OGG_PAGE_HEADER.size <= len(data):
+        capture, version, header_type, granule, page_serial, _, _, segments = OGG_PAGE_HEADER.unpack_from(data, position)
+        if capture != b"OggS" or version != 0:
+            raise ValueError(f"bad Ogg page at offset {position}")
+        lacing = data[position + OGG_PAGE_HEADER.size:position + OGG_PAGE_HEADER.size + segments]
+        body = position + OGG_PAGE_HEADER.size + segments
+        position = body + sum(lacing)
+        if serial is None:
+            serial = page_serial
+        elif page_serial != serial:
+            # multiplexed streams, only the first one is audio we know about
+            continue
+        completed = []
+        start = body
+        for size in lacing:
+            partial += data[start:start + size]
+            start += size
+            # a lacing value under 255 ends a packet, 255 means it continues in the next segment
+            if size < 255:
+                completed.append(partial)
+                partial = b""
+        for index, packet in enumerate(completed):
+            yield packet, granule if index == len(completed) - 1 else -1
+
+
+class OpusAsset():
+    '''
+    Opus packets demuxed from an Ogg file plus a packet index.
+    granules[i] is the 48kHz sample position at which packet i starts in the decoded stream, for seeking.
+
+    The first pre_skip samples the file decodes to are encoder delay and the stream ends at the last page's
+    granule position, partway into the last packet. Packets that fall wholly before or after the audio are
+    dropped here. What remains is skip_samples to drop from the start of the first packet's output and
+    trim_samples from the end of the last one's, which the device does after decoding.
+    '''
+    def __init__(self, packets, granules, channels, pre_skip, frame_duration, skip_samples=0, trim_samples=0):
+        self.packets = packets
+        self.granules = granules
+        self.channels = channels
+        self.pre_skip = pre_skip
+        self.frame_duration = frame_duration
+        self.skip_samples = skip_samples
+        self.trim_samples = trim_samples
+
+
+def load_opus_file(file_path):
+    """Demux an Ogg/Opus file into an OpusAsset, skipping the OpusHead and OpusTags headers."""
+    with open(file_path, "rb") as f:
+        data = f.read()
+    packets_with_granules = read_ogg_packets(data)
+    try:
+        head, _ = next(packets_with_granules)
+        next(packets_with_granules)  # OpusTags
+    except StopIteration:
+        raise ValueError(f"{file_path} has no Opus headers")
+    if head[:8] != b"OpusHead":
+        raise ValueError(f"{file_path} is not an Ogg/Opus file")
+    channels = head[9]
+    pre_skip, = struct.unpack_from("<H", head, 10)
+
+    packets = []
+    granules = []
+    position = 0
+    end = None
+    for packet, granule in packets_with_granules:
+        if granule >= 0:
+            end = granule
+        if not packet:
+            continue
+        packets.append(packet)
+        granules.append(position)
+        position += packet_samples(packet)
+    # the last page says where the audio ends, without one it runs to the end of the last packet
+    end = position if end is None else min(end, position)
+
+    first = 0
+    while first < len(packets) and granules[first] + packet_samples(packets[first]) <= pre_skip:
+        first += 1
+    last = len(packets)
+    while last > first and granules[last - 1] >= end:
+        last -= 1
+    packets = packets[first:last]
+    granules = granules[first:last]
+    skip_samples = max(0, pre_skip - granules[0]) if packets else 0
+    trim_samples = granules[-1] + packet_samples(packets[-1]) - end if packets else 0
+    frame_duration = packet_samples(packets[0]) / 48000 if packets else 20/1000
+    return OpusAsset(packets, granules, channels, pre_skip, frame_duration, skip_samples, trim_samples)
@@ -0,0 +1,116 @@
+import asyncio
+import logging
+import math
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class TimerWheel():
+    '''
+    Hashed timer wheel run by one thread, shared by every audio stream in the process.
+
+    Deadlines are rounded up to the next tick and dropped into slot tick % slots. The thread
+    only runs while timers are pending, an idle server has no wakeups at all.
+    '''
+    def __init__(self, tick=0.005, slots=256):
+        self.tick = tick
+        self._slots = [[] for _ in range(slots)]
+        self._pending = 0
+        self._current = 0  # last tick that has been fired
+        self._origin = time.monotonic()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def _now_tick(self):
+        return math.floor((time.monotonic() - self._origin) / self.tick)
+
+    def schedule(self, deadline, callback):
+        """Call callback from the wheel thread at or just after the time.monotonic() deadline."""
+        with self._cond:
+            if self._pending == 0:
+                # nothing is waiting on the old ticks, skip straight to now instead of replaying them
+                self._current = max(self._current, self._now_tick())
+            tick = max(math.ceil((deadline - self._origin) / self.tick), self._current + 1)
+            self._slots[tick % len(self._slots)].append((tick, callback))
+            self._pending += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="timer-wheel", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def sleep_until(self, deadline):
+        """Block the calling thread until deadline."""
+        if deadline <= time.monotonic():
+            return
+        done = threading.Event()
+        self.schedule(deadline, done.set)
+        done.wait()
+
+    async def async_sleep_until(self, deadline):
+        """Suspend the calling coroutine until deadline."""
+        if deadline <= time.monotonic():
+            return
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            if not future.done():
+                future.set_result(None)
+        self.schedule(deadline, lambda: loop.call_soon_threadsafe(wake))
+        await future
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pending == 0:
+                    self._cond.wait()
+                due = []
+                now_tick = self._now_tick()
+                while self._current < now_tick:
+                    self._current += 1
+                    slot = self._slots[self._current % len(self._slots)]
+                    if not slot:
+                        continue
+                    keep = []
+                    for entry in slot:
+                        (due if entry[0] <= self._current else keep).append(entry)
+                    slot[:] = keep
+                self._pending -= len(due)
+                next_tick = self._origin + (self._current + 1) * self.tick
+            for _, callback in due:
+                try:
+                    callback()
+                except Exception:
+                    logger.exception("error in timer callback")
+            time.sleep(max(0, next_tick - time.monotonic()))
+
+
+class Pacer():
+    '''
+    Releases frame i of a clip on the media clock: the first lead_frames frames go out at once,
+    after that one frame per frame_duration. The client never holds more than lead_frames of
+    audio ahead of playback, and a stop lands within one frame.
+    start defaults to now, a broadcast passes the time.monotonic() every device starts at.
+    '''
+    def __init__(self, wheel, frame_duration=20/1000, lead_frames=5, start=None):
+        self.wheel = wheel
+        self.frame_duration = frame_duration
+        self.lead_frames = lead_frames
+        self.start = time.monotonic() if start is None else start
+
+    def release_time(self, index):
+        return self.start + (index - self.lead_frames) * self.frame_duration
+
+    def lag(self, index, sent):
+        """How late frame index went out at sent. The lead frames are due at start, not before it."""
+        return sent - max(self.release_time(index), self.start)
+
+    def wait(self, index):
+        """Block until frame index may be sent."""
+        self.wheel.sleep_until(self.release_time(index))
+
+    async def async_wait(self, index):
+        """Suspend until frame index may be sent."""
+        await self.wheel.async_sleep_until(self.release_time(index))
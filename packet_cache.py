@@ -0,0 +1,244 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent import futures
+
+import audio
+import ogg_opus
+from packet_pack import PacketIndex
+from preprocess import AssetPreparer
+
+logger = logging.getLogger(__name__)
+
+
+# pre-encoded assets, their packets are served as they are
+OPUS_EXTENSIONS = (".opus", ".ogg")
+
+
+class EncodedClip():
+    '''
+    Opus packets for one audio file and the duration of each packet, which is the
+    requested frame duration for encoded WAVs and whatever the file was made with for Ogg/Opus.
+    digest is the sha256 of the file the packets came from, bitrate the rung of the bitrate ladder
+    it was encoded at, None for Ogg/Opus files.
+    skip_samples and trim_samples are dropped from the start of the first packet's and the end of the last
+    packet's decoded audio, an Ogg/Opus file's pre-skip and end padding. Encoded WAVs have neither.
+    '''
+    def __init__(self, packets, frame_duration, digest=None, bitrate=None, skip_samples=0, trim_samples=0):
+        self.packets = packets
+        self.frame_duration = frame_duration
+        self.digest = digest
+        self.bitrate = bitrate
+        self.skip_samples = skip_samples
+        self.trim_samples = trim_samples
+
+
+class CacheEntry():
+    '''
+    An encoded clip, plus what we need to tell if the file changed on disk.
+    A clip out of a packet pack lives in the page cache, not the heap, and isn't counted against the budget.
+    '''
+    def __init__(self, clip, mtime_ns, size, digest):
+        self.clip = clip
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.digest = digest
+        if isinstance(clip.packets, PacketIndex):
+            self.nbytes = 0
+        else:
+            self.nbytes = sum(len(packet) for packet in clip.packets)
+
+
+def file_digest(file_path):
+    """Return the sha256 hex digest of a file, read in 1MB blocks."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class AudioPacketCache():
+    '''
+    Holds each audio file as a list of ready-to-send Opus packets so a Play press never re-encodes.
+    WAVs are cached separately for every frame duration and bitrate a device has asked for, Ogg/Opus files
+    are demuxed into their packets once and never encoded. Encodes of one file at one frame duration
+    line up packet for packet whatever the bitrate, so a stream can switch rungs mid clip.
+
+    WAVs go through the preparer first, which converts any rate, channel count and sample format to
+    48kHz mono 16 bit once per file content, so the encoders always get what they are set up for.
+
+    With a batch_encoder, WAVs are encoded in its worker processes instead of on this one's encoder pool.
+    With a pack, a WAV whose content and format are in the packet pack is served from the map and never encoded.
+
+    Entries are kept in LRU order and evicted once the encoded bytes go over max_bytes.
+    An entry is re-validated on every lookup with os.stat, if the mtime or size moved the
+    file is hashed and only re-encoded when the content actually changed.
+    '''
+    def __init__(self, max_bytes=64 * 1024 * 1024, frame_duration=20/1000, encoder_pool=None,
+                 bitrate=audio.BITRATE_LADDER[-1], preparer=None, batch_encoder=None, pack=None):
+        self.max_bytes = max_bytes
+        self.frame_duration = frame_duration
+        # WAVs asked for without a bitrate are encoded at the top of the ladder, the rate a healthy stream plays at
+        self.bitrate = bitrate
+        self.encoder_pool = encoder_pool or audio.OpusEncoderPool()
+        self.preparer = preparer or AssetPreparer(sample_rate=self.encoder_pool.sample_rate)
+        self.batch_encoder = batch_encoder
+        self.pack = pack
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # one lock per file so two devices pressing play on a cold file only encode it once
+        self._fill_locks = {}
+        # background encodes of other bitrate rungs, see warm()
+        self._warmer = futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="cache-warm")
+        self._warming = set()
+
+    def _key(self, file_path, frame_duration, bitrate):
+        if file_path.endswith(OPUS_EXTENSIONS):
+            # the file decides the frame duration and bitrate
+            return (file_path, None, None)
+        return (file_path, frame_duration or self.frame_duration, bitrate or self.bitrate)
+
+    def peek(self, file_path, frame_duration=None, bitrate=None):
+        """Return the cached EncodedClip if it is there and current, never encodes."""
+        key = self._key(file_path, frame_duration, bitrate)
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None
+        with self._lock:
+            entry = self._lookup(key, stat)
+            return entry.clip if entry is not None else None
+
+    def warm(self, file_path, frame_duration=None, bitrate=None):
+        """Encode file_path at this frame duration and bitrate in the background, if it isn't cached already."""
+        key = self._key(file_path, frame_duration, bitrate)
+        with self._lock:
+            if key in self._warming:
+                return
+            self._warming.add(key)
+
+        def fill():
+            try:
+                self.get(file_path, frame_duration, bitrate)
+            except Exception:
+                logger.exception("error warming %s", key)
+            finally:
+                with self._lock:
+                    self._warming.discard(key)
+        self._warmer.submit(fill)
+
+    def get(self, file_path, frame_duration=None, bitrate=None):
+        """Return the EncodedClip for file_path, encoding or demuxing it on a miss."""
+        key = self._key(file_path, frame_duration, bitrate)
+        _, frame_duration, bitrate = key
+        stat = os.stat(file_path)
+        with self._lock:
+            entry = self._lookup(key, stat)
+            if entry is not None:
+                self.hits += 1
+                return entry.clip
+            fill_lock = self._fill_locks.setdefault(key, threading.Lock())
+
+        with fill_lock:
+            # another stream may have filled it while we waited
+            with self._lock:
+                entry = self._lookup(key, stat)
+                if entry is not None:
+                    self.hits += 1
+                    return entry.clip
+            digest = file_digest(file_path)
+            with self._lock:
+                stale = self._entries.get(key)
+                if stale is not None and stale.digest == digest:
+                    # touched but not changed, keep the packets
+                    stale.mtime_ns = stat.st_mtime_ns
+                    stale.size = stat.st_size
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return stale.clip
+                self.misses += 1
+            if frame_duration is None:
+                clip = self._demux(file_path)
+            else:
+                clip = self._unpack(file_path, frame_duration, bitrate, digest)
+                if clip is None:
+                    clip = self._encode(file_path, frame_duration, bitrate, digest)
+            clip.digest = digest
+            entry = CacheEntry(clip, stat.st_mtime_ns, stat.st_size, digest)
+            with self._lock:
+                self._store(key, entry)
+            return clip
+
+    def invalidate(self, file_path=None):
+        """Drop one file at every frame duration and bitrate from the cache, or everything when file_path is None."""
+        with self._lock:
+            for key in list(self._entries):
+                if file_path is None or key[0] == file_path:
+                    self.total_bytes -= self._entries.pop(key).nbytes
+
+    def _lookup(self, key, stat):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.mtime_ns != stat.st_mtime_ns or entry.size != stat.st_size:
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _store(self, key, entry):
+        if key in self._entries:
+            self.total_bytes -= self._entries.pop(key).nbytes
+        if entry.nbytes > self.max_bytes:
+            # bigger than the whole budget, serve it but don't keep it
+            logger.warning("%s is %d bytes encoded, over budget, not caching", key, entry.nbytes)
+            return
+        self._entries[key] = entry
+        self.total_bytes += entry.nbytes
+        while self.total_bytes > self.max_bytes:
+            evicted_key, evicted = self._entries.popitem(last=False)
+            self.total_bytes -= evicted.nbytes
+            logger.info("evicted %s", evicted_key)
+
+    def _unpack(self, file_path, frame_duration, bitrate, digest):
+        if self.pack is None:
+            return None
+        clip = self.pack.clip(os.path.basename(file_path), frame_duration, bitrate, digest)
+        if clip is not None:
+            logger.info("loaded %s at %gms and %d bps from %s", file_path, frame_duration * 1000, bitrate,
+                        self.pack.file_path)
+        return clip
+
+    def _encode(self, file_path, frame_duration, bitrate, digest):
+        # the prepared copy is made on the first encode of this content and shared by every rung
+        prepared = self.preparer.prepare(file_path, digest)
+        if self.batch_encoder is not None:
+            packets = self.batch_encoder.encode(prepared, frame_duration, bitrate)
+        else:
+            # each fill checks out its own encoder, fills of different files run in parallel
+            with self.encoder_pool.encoder(settings=audio.OpusSettings(bitrate=bitrate)) as opus_encoder:
+                packets = audio.encode_wav(prepared, opus_encoder, frame_duration)
+        logger.info("encoded %s into %d packets of %gms at %d bps", file_path, len(packets), frame_duration * 1000,
+                    bitrate)
+        return EncodedClip(packets, frame_duration, bitrate=bitrate)
+
+    def close(self):
+        """Stop the background encodes and the batch encoder's processes."""
+        self._warmer.shutdown(wait=False, cancel_futures=True)
+        if self.batch_encoder is not None:
+            self.batch_encoder.close()
+        if self.pack is not None:
+            self.pack.close()
+
+    def _demux(self, file_path):
+        asset = ogg_opus.load_opus_file(file_path)
+        if asset.channels != self.encoder_pool.channels:
+            raise ValueError(f"{file_path} has {asset.channels} channels, devices expect {self.encoder_pool.channels}")
+        logger.info("loaded %s as %d Opus packets of %gms", file_path, len(asset.packets), asset.frame_duration * 1000)
+        return EncodedClip(asset.packets, asset.frame_duration, skip_samples=asset.skip_samples,
+                           trim_samples=asset.trim_samples)
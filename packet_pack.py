@@ -0,0 +1,155 @@
+'''
+Packet packs: the Opus packets of a whole asset library in one file, written offline by batch_encode.py
+and memory-mapped by the server, so a pod loads its clips without encoding anything.
+
+Layout, all little endian:
+    header       magic, version, clip count
+    clip table   one entry per encode: name, source digest, frame duration, bitrate, packet count,
+                 and where its index and payload are in the file
+    per clip     index: timestamps in microseconds (uint64), payload offsets (uint32) and lengths (uint32),
+                 one array each with a value per packet, then the payload: the packets back to back
+
+The arrays are cast straight out of the map and a packet is a memoryview slice of the payload, so a loaded
+clip holds no Python object per packet. The pages are the file's, in the page cache and shared by every
+process that maps it.
+'''
+import array
+import logging
+import mmap
+import os
+import struct
+import sys
+import uuid
+from collections.abc import Sequence
+
+logger = logging.getLogger(__name__)
+
+PACK_MAGIC = b"OPKP"
+PACK_VERSION = 2
+
+# magic, version, clip count
+PACK_HEADER = struct.Struct("<4sHxxI")
+# name length, frame duration in microseconds, bitrate (0 when the file decided it), packet count,
+# index offset, payload offset, payload size, sha256 of the source file
+CLIP_ENTRY = struct.Struct("<HxxIIIQQQ32s")
+ALIGN = 8
+
+
+def _pad(size):
+    return -size % ALIGN
+
+
+class PacketIndex(Sequence):
+    '''
+    The packets of one clip, read through its index. packets[seq] is a memoryview of one packet,
+    packets[a:b] a list of them, both O(1) in the clip's length.
+    '''
+    def __init__(self, payload, timestamps_us, offsets, lengths):
+        self.payload = payload
+        self.timestamps_us = timestamps_us
+        self.offsets = offsets
+        self.lengths = lengths
+        self.nbytes = len(payload)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, seq):
+        if isinstance(seq, slice):
+            return [self[i] for i in range(*seq.indices(len(self)))]
+        offset = self.offsets[seq]
+        return self.payload[offset:offset + self.lengths[seq]]
+
+
+def write_pack(file_path, clips):
+    """Write clips, a list of (asset name, EncodedClip), to file_path. The file is written aside and renamed."""
+    entries = []
+    blobs = []
+    position = PACK_HEADER.size + sum(CLIP_ENTRY.size + len(name.encode()) for name, _ in clips)
+    position += _pad(position)
+    for name, clip in clips:
+        packets = [bytes(packet) for packet in clip.packets]
+        timestamps = array.array("Q", (round(seq * clip.frame_duration * 1_000_000) for seq in range(len(packets))))
+        offsets = array.array("I")
+        total = 0
+        for packet in packets:
+            offsets.append(total)
+            total += len(packet)
+        lengths = array.array("I", (len(packet) for packet in packets))
+        if sys.byteorder != "little":
+            for values in (timestamps, offsets, lengths):
+                values.byteswap()
+        index = timestamps.tobytes() + offsets.tobytes() + lengths.tobytes()
+        index += bytes(_pad(len(index)))
+        payload = b"".join(packets)
+        entries.append(CLIP_ENTRY.pack(len(name.encode()), round(clip.frame_duration * 1_000_000), clip.bitrate or 0,
+                                       len(packets), position, position + len(index), len(payload),
+                                       bytes.fromhex(clip.digest) if clip.digest else bytes(32)) + name.encode())
+        blobs.append(index + payload + bytes(_pad(len(payload))))
+        position += len(blobs[-1])
+
+    partial = f"{file_path}.{uuid.uuid4().hex[:8]}.tmp"
+    with open(partial, "wb") as f:
+        f.write(PACK_HEADER.pack(PACK_MAGIC, PACK_VERSION, len(entries)))
+        for entry in entries:
+            f.write(entry)
+        f.write(bytes(_pad(f.tell())))
+        for blob in blobs:
+            f.write(blob)
+    os.replace(partial, file_path)
+
+
+class PacketPack():
+    '''
+    A packet pack mapped read only. clip() finds an encode by asset name, frame duration and bitrate,
+    and only hands it out when it was made from the file content the caller has.
+    '''
+    def __init__(self, file_path):
+        if sys.byteorder != "little":
+            raise RuntimeError("packet packs are only mapped on little endian machines")
+        self.file_path = file_path
+        with open(file_path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        magic, version, count = PACK_HEADER.unpack_from(self._view, 0)
+        if magic != PACK_MAGIC:
+            raise ValueError(f"{file_path} is not a packet pack")
+        if version != PACK_VERSION:
+            raise ValueError(f"{file_path} is pack version {version}, expected {PACK_VERSION}")
+        # (name, frame duration in microseconds, bitrate) -> (digest, PacketIndex)
+        self._clips = {}
+        offset = PACK_HEADER.size
+        for _ in range(count):
+            (name_length, frame_us, bitrate, packet_count, index_offset, payload_offset, payload_size,
+             digest) = CLIP_ENTRY.unpack_from(self._view, offset)
+            offset += CLIP_ENTRY.size
+            name = bytes(self._view[offset:offset + name_length]).decode()
+            offset += name_length
+            timestamps_end = index_offset + 8 * packet_count
+            offsets_end = timestamps_end + 4 * packet_count
+            packets = PacketIndex(self._view[payload_offset:payload_offset + payload_size],
+                                  self._view[index_offset:timestamps_end].cast("Q"),
+                                  self._view[timestamps_end:offsets_end].cast("I"),
+                                  self._view[offsets_end:offsets_end + 4 * packet_count].cast("I"))
+            self._clips[(name, frame_us, bitrate or None)] = (digest.hex(), packets)
+        logger.info("mapped %d clips from %s, %d bytes", len(self._clips), file_path, len(self._mmap))
+
+    def __len__(self):
+        return len(self._clips)
+
+    def clip(self, name, frame_duration, bitrate, digest):
+        """EncodedClip for this encode of name made from content with this sha256, or None if the pack hasn't got it."""
+        from packet_cache import EncodedClip
+        found = self._clips.get((name, round(frame_duration * 1_000_000), bitrate))
+        if found is None or found[0] != digest:
+            return None
+        return EncodedClip(found[1], frame_duration, digest=digest, bitrate=bitrate)
+
+    def close(self):
+        self._clips = {}
+        self._view = None
+        try:
+            self._mmap.close()
+        except BufferError:
+            # a clip is still being streamed, the map is freed with its last packet
+            pass
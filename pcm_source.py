@@ -0,0 +1,102 @@
+import mmap
+import struct
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+def parse_wav_header(m, file_path):
+    '''
+    Walk the RIFF chunks of a WAV held in a buffer.
+    Returns (audio_format, channels, sample_rate, block_align, sample_width in bytes, data offset, data size).
+    '''
+    if len(m) < 12 or m[0:4] != b"RIFF" or m[8:12] != b"WAVE":
+        raise ValueError(f"{file_path} is not a WAV file")
+    fmt = None
+    position = 12
+    while position + 8 <= len(m):
+        chunk_id = m[position:position + 4]
+        chunk_size, = struct.unpack_from("<I", m, position + 4)
+        body = position + 8
+        if chunk_id == b"fmt ":
+            fmt = struct.unpack_from("<HHIIHH", m, body)
+            if fmt[0] == WAVE_FORMAT_EXTENSIBLE and chunk_size >= 40:
+                # the real format tag is the first two bytes of the sub format GUID
+                fmt = (struct.unpack_from("<H", m, body + 24)[0],) + fmt[1:]
+        elif chunk_id == b"data":
+            if fmt is None:
+                raise ValueError(f"{file_path} has a data chunk before its fmt chunk")
+            audio_format, channels, sample_rate, _, block_align, bits = fmt
+            # a truncated file claims more data than it has, serve what is there
+            return audio_format, channels, sample_rate, block_align, bits // 8, body, min(chunk_size, len(m) - body)
+        # chunks are padded to an even length
+        position = body + chunk_size + (chunk_size & 1)
+    raise ValueError(f"{file_path} has no data chunk")
+
+
+class PcmSource():
+    '''
+    Memory-mapped 16 bit PCM WAV file that hands out frames as memoryview slices, without copying.
+
+    The RIFF header is parsed once and only the data chunk is exposed. Streams reading the same
+    file share the page cache pages instead of each holding a copy. The last, short frame is
+    copied into a zero-padded scratch buffer allocated up front, since the encoder only takes whole frames.
+    '''
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self._file = open(file_path, "rb")
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # an empty file can't be mapped
+            self._file.close()
+            raise ValueError(f"{file_path} is not a WAV file")
+        try:
+            data_offset, data_size = self._parse_header()
+        except Exception:
+            self.close()
+            raise
+        self._view = memoryview(self._mmap)[data_offset:data_offset + data_size]
+        self.nframes = data_size // self.block_align
+
+    def _parse_header(self):
+        (audio_format, self.channels, self.sample_rate, self.block_align, self.sample_width,
+         data_offset, data_size) = parse_wav_header(self._mmap, self.file_path)
+        if audio_format != WAVE_FORMAT_PCM or self.sample_width != 2:
+            raise ValueError(f"{self.file_path} is not 16 bit PCM")
+        return data_offset, data_size
+
+    def frames(self, frame_size, start=0):
+        '''
+        Yield the audio as memoryviews of exactly frame_size samples per channel, from frame number start on.
+        Each view is only valid until the next one is requested, copy it if you need to keep it.
+        '''
+        frame_bytes = frame_size * self.block_align
+        scratch = bytearray(frame_bytes)
+        whole = len(self._view) - len(self._view) % frame_bytes
+        for offset in range(start * frame_bytes, whole, frame_bytes):
+            frame = self._view[offset:offset + frame_bytes]
+            yield frame
+            frame.release()
+        tail = len(self._view) - whole
+        if tail:
+            scratch[:tail] = self._view[whole:]
+            yield memoryview(scratch)
+
+    def close(self):
+        if getattr(self, "_view", None) is not None:
+            self._view.release()
+            self._view = None
+        try:
+            self._mmap.close()
+        except BufferError:
+            # a frame is still held by a consumer that stopped early, the map is freed with it
+            pass
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
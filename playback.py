@@ -0,0 +1,292 @@
+'''
+Streaming playback for the client: decoded PCM goes into a jitter buffer and a sink thread plays it
+while packets are still arriving, instead of writing a WAV and running pw-play after is_end.
+'''
+import subprocess
+import threading
+import time
+import wave
+
+
+class RingBuffer():
+    '''
+    Fixed size byte ring, allocated once. When a write doesn't fit, the oldest audio is dropped.
+    '''
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._buffer = bytearray(capacity)
+        self._view = memoryview(self._buffer)
+        self._read = 0
+        self.size = 0
+        self.dropped = 0
+
+    def clear(self):
+        self._read = 0
+        self.size = 0
+
+    def write(self, data):
+        data = memoryview(data).cast("B")
+        if len(data) > self.capacity:
+            self.dropped += len(data) - self.capacity
+            data = data[-self.capacity:]
+        overflow = self.size + len(data) - self.capacity
+        if overflow > 0:
+            self._read = (self._read + overflow) % self.capacity
+            self.size -= overflow
+            self.dropped += overflow
+        start = (self._read + self.size) % self.capacity
+        first = min(len(data), self.capacity - start)
+        self._view[start:start + first] = data[:first]
+        self._view[:len(data) - first] = data[first:]
+        self.size += len(data)
+
+    def readinto(self, out):
+        """Copy up to len(out) bytes into out, return how many were copied."""
+        count = min(len(out), self.size)
+        first = min(count, self.capacity - self._read)
+        out[:first] = self._view[self._read:self._read + first]
+        out[first:count] = self._view[:count - first]
+        self._read = (self._read + count) % self.capacity
+        self.size -= count
+        return count
+
+
+class RealtimeClock():
+    '''
+    Makes a sink that has no sound card consume audio at the sample rate, like a real device would.
+    '''
+    def __init__(self, sample_rate=48000, channels=1):
+        self.bytes_per_second = sample_rate * channels * 2
+        self.start = None
+        self.written = 0
+
+    def wait(self, nbytes):
+        now = time.monotonic()
+        if self.start is None or now > self.start + self.written / self.bytes_per_second:
+            # first write, or the sink sat idle between clips
+            self.start = now
+            self.written = 0
+        self.written += nbytes
+        time.sleep(max(0, self.start + self.written / self.bytes_per_second - now))
+
+
+class NullSink():
+    """Discards audio, for headless runs where only the timing matters."""
+    def __init__(self, sample_rate=48000, channels=1, realtime=True):
+        self.clock = RealtimeClock(sample_rate, channels) if realtime else None
+
+    def write(self, pcm):
+        if self.clock:
+            self.clock.wait(len(pcm))
+
+    def close(self):
+        pass
+
+
+class WavFileSink():
+    """Writes the played audio to a WAV file."""
+    def __init__(self, file_path, sample_rate=48000, channels=1, realtime=False):
+        self.clock = RealtimeClock(sample_rate, channels) if realtime else None
+        self.wave_file = wave.open(file_path, "wb")
+        self.wave_file.setnchannels(channels)
+        self.wave_file.setframerate(sample_rate)
+        self.wave_file.setsampwidth(2)
+
+    def write(self, pcm):
+        if self.clock:
+            self.clock.wait(len(pcm))
+        self.wave_file.writeframes(pcm)
+
+    def close(self):
+        self.wave_file.close()
+
+
+class PwPlaySink():
+    '''
+    Pipes raw 16 bit PCM into pw-play on stdin. pw-play reads at the device rate,
+    so the pipe applies the real-time backpressure to the sink thread.
+    '''
+    def __init__(self, sample_rate=48000, channels=1):
+        self.process = subprocess.Popen(
+            ["pw-play", "--raw", "--format", "s16", "--rate", str(sample_rate), "--channels", str(channels), "-"],
+            stdin=subprocess.PIPE)
+
+    def write(self, pcm):
+        self.process.stdin.write(pcm)
+        self.process.stdin.flush()
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+def make_sink(output, sample_rate=48000, channels=1):
+    """Build a sink from a name: "pw-play", "null", or a path ending in .wav."""
+    if output == "pw-play":
+        return PwPlaySink(sample_rate, channels)
+    if output == "null":
+        return NullSink(sample_rate, channels)
+    if output.endswith(".wav"):
+        return WavFileSink(output, sample_rate, channels, realtime=True)
+    raise ValueError(f"unknown audio output {output!r}")
+
+
+def trim_pcm(pcm, skip_samples, trim_samples, channels=1):
+    """Drop an AudioPacket's skip_samples from the start and trim_samples from the end of its decoded 16 bit PCM."""
+    if not skip_samples and not trim_samples:
+        return pcm
+    sample_bytes = 2 * channels
+    pcm = memoryview(pcm).cast("B")
+    return pcm[skip_samples * sample_bytes:max(0, len(pcm) - trim_samples * sample_bytes)]
+
+
+class StreamingPlayer():
+    '''
+    Jitter buffer in front of an output sink.
+
+    Playback of a clip starts once target_depth periods are buffered. If the sink runs dry before
+    the clip has ended that is an underrun: the target grows by one period (up to max_depth) and the
+    player re-buffers. After a long run without underruns the target shrinks back towards min_depth,
+    so a good link ends up with a few frames of delay and a bad one with enough to ride out jitter.
+    '''
+    def __init__(self, sink, sample_rate=48000, channels=1, period=20/1000,
+                 min_depth=3, max_depth=25, capacity_seconds=2.0):
+        self.sink = sink
+        self.period_bytes = int(sample_rate * period) * channels * 2
+        self.min_depth = min_depth
+        self.max_depth = max_depth
+        self.target_depth = min_depth
+        self.underruns = 0
+        self._ring = RingBuffer(int(sample_rate * capacity_seconds) * channels * 2)
+        self._scratch = bytearray(self.period_bytes)
+        self._cond = threading.Condition()
+        self._buffering = True
+        self._ending = False
+        self._closed = False
+        self._steady_periods = 0
+        self._thread = threading.Thread(target=self._run, name="playback-sink", daemon=True)
+        self._thread.start()
+
+    def start_clip(self):
+        """A new clip interrupts whatever is still buffered from the last one."""
+        with self._cond:
+            self._ring.clear()
+            self._buffering = True
+            self._ending = False
+
+    def write(self, pcm):
+        with self._cond:
+            self._ring.write(pcm)
+            self._cond.notify()
+
+    def end_clip(self):
+        """No more audio for this clip, play out what is buffered."""
+        with self._cond:
+            self._ending = True
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(timeout=1.0)
+        self.sink.close()
+
+    def _ready(self):
+        if self._closed:
+            return True
+        if self._buffering:
+            return self._ring.size >= self.target_depth * self.period_bytes or (self._ending and self._ring.size)
+        # playing: the sink wants the next period now, whether or not it has arrived
+        return True
+
+    def _run(self):
+        view = memoryview(self._scratch)
+        while True:
+            with self._cond:
+                self._cond.wait_for(self._ready)
+                if self._closed:
+                    return
+                self._buffering = False
+                if self._ring.size < self.period_bytes and not self._ending:
+                    # ran dry mid clip: give the network more slack and wait to re-buffer
+                    self.underruns += 1
+                    self.target_depth = min(self.max_depth, self.target_depth + 1)
+                    self._steady_periods = 0
+                    self._buffering = True
+                    continue
+                count = self._ring.readinto(view)
+                if count == 0:
+                    # clip fully played out
+                    self._ending = False
+                    self._buffering = True
+                    continue
+                self._steady_periods += 1
+                if self._steady_periods >= 500 and self.target_depth > self.min_depth:
+                    self.target_depth -= 1
+                    self._steady_periods = 0
+            self.sink.write(view[:count])
+
+
+class PrerollBuffer():
+    '''
+    Decoded PCM of a provisional pre-roll, held back from the player until Play.
+
+    The server sends the start of the selected clip on a Mode press. commit() hands it to the player,
+    from the Play button straight away or when the server's continuation arrives, whichever is first,
+    and anything of the pre-roll that arrives after that goes to the player directly.
+    A new pre-roll or a discard drops what is held.
+    '''
+    def __init__(self, player):
+        self.player = player
+        self.next_seq = None
+        self._pcm = []
+        self._committed = False
+        self._lock = threading.Lock()
+
+    def begin(self):
+        with self._lock:
+            self._pcm = []
+            self._committed = False
+            self.next_seq = 0
+
+    def add(self, pcm, next_seq):
+        with self._lock:
+            if self.next_seq is None:
+                return
+            self.next_seq = next_seq
+            if self._committed:
+                self.player.write(pcm)
+            else:
+                # the decoder returns a view of its own buffer, which the next frame overwrites
+                self._pcm.append(bytes(pcm))
+
+    def discard(self):
+        with self._lock:
+            self._pcm = []
+            self._committed = False
+            self.next_seq = None
+
+    def commit(self):
+        """Start playing the held pre-roll, returns False if there is none."""
+        with self._lock:
+            if self.next_seq is None or self._committed:
+                return False
+            self._committed = True
+            self.player.start_clip()
+            for pcm in self._pcm:
+                self.player.write(pcm)
+            self._pcm = []
+            return True
+
+    def take(self, seq):
+        '''
+        Called with each packet that isn't provisional: True if it carries on the pre-roll at seq, which is then
+        committed if Play hasn't already. Either way the pre-roll is over.
+        '''
+        with self._lock:
+            follows = self.next_seq is not None and seq == self.next_seq
+        if follows:
+            self.commit()
+        self.discard()
+        return follows
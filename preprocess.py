@@ -0,0 +1,182 @@
+'''
+Asset preprocessing: any PCM or float WAV is turned into what the Opus encoders take, 48kHz mono 16 bit,
+with its loudness brought to a common level and short fades at both ends so clips don't click.
+Everything works on whole NumPy arrays, and runs once per file content. The result is written next to
+the other prepared assets and reused by every encode, at every frame duration and bitrate.
+'''
+import hashlib
+import logging
+import math
+import mmap
+import os
+import threading
+import time
+import uuid
+import wave
+
+import numpy as np
+
+from pcm_source import WAVE_FORMAT_PCM, WAVE_FORMAT_IEEE_FLOAT, parse_wav_header
+
+logger = logging.getLogger(__name__)
+
+# bump when the pipeline changes, prepared files from an older version are made again
+PREPARE_VERSION = 1
+
+
+def read_wav(file_path):
+    """Samples of a PCM (8, 16, 24 or 32 bit) or float WAV as float64 in [-1, 1], shape (frames, channels), and the rate."""
+    with open(file_path, "rb") as f:
+        try:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise ValueError(f"{file_path} is not a WAV file")
+        try:
+            audio_format, channels, sample_rate, block_align, width, offset, size = parse_wav_header(m, file_path)
+            size -= size % block_align
+            data = bytes(m[offset:offset + size])
+        finally:
+            m.close()
+    if audio_format == WAVE_FORMAT_IEEE_FLOAT and width in (4, 8):
+        samples = np.frombuffer(data, dtype="<f4" if width == 4 else "<f8").astype(np.float64)
+    elif audio_format != WAVE_FORMAT_PCM:
+        raise ValueError(f"{file_path} has format tag {audio_format:#x}, only PCM and float WAVs are supported")
+    elif width == 1:
+        # 8 bit WAVs are unsigned
+        samples = (np.frombuffer(data, dtype=np.uint8).astype(np.float64) - 128) / 128
+    elif width == 2:
+        samples = np.frombuffer(data, dtype="<i2") / 32768
+    elif width == 3:
+        raw = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        packed = raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)
+        # sign extend from 24 bits
+        samples = ((packed << 8) >> 8) / 2 ** 23
+    elif width == 4:
+        samples = np.frombuffer(data, dtype="<i4") / 2 ** 31
+    else:
+        raise ValueError(f"{file_path} has {width * 8} bit samples")
+    return samples.reshape(-1, channels), sample_rate
+
+
+def downmix(samples):
+    """Average the channels of a (frames, channels) array into one."""
+    return samples.mean(axis=1)
+
+
+def resample(samples, rate_in, rate_out, zero_crossings=16, block=1 << 16):
+    '''
+    Polyphase resampling of a mono signal by rate_out/rate_in, reduced to up/down.
+
+    The low pass is a Kaiser windowed sinc at the lower of the two Nyquist frequencies, split into
+    up phases of equal length. Each output sample is one phase dotted with the input around it,
+    done for block output samples at a time with gathered index arrays instead of a Python loop per sample.
+    '''
+    if rate_in == rate_out:
+        return samples
+    divisor = math.gcd(rate_in, rate_out)
+    up, down = rate_out // divisor, rate_in // divisor
+    cutoff = 1.0 / max(up, down)
+    half = zero_crossings * max(up, down)
+    t = np.arange(-half, half + 1)
+    # gain of up makes up for the zeros the upsampling puts between input samples
+    taps = up * cutoff * np.sinc(cutoff * t) * np.kaiser(len(t), 8.0)
+    per_phase = -(-len(taps) // up)
+    taps = np.concatenate([taps, np.zeros(per_phase * up - len(taps))])
+    # phases[p, k] is the tap that meets the input sample k steps back, at upsampled offset p
+    phases = taps.reshape(per_phase, up).T
+    padded = np.concatenate([np.zeros(per_phase), samples, np.zeros(per_phase)])
+    out_length = -(-len(samples) * up // down)
+    out = np.empty(out_length)
+    back = np.arange(per_phase)
+    for start in range(0, out_length, block):
+        # position of each output sample on the upsampled grid, shifted by half so the filter is centred
+        position = np.arange(start, min(start + block, out_length)) * down + half
+        index = (position // up)[:, None] - back[None, :] + per_phase
+        np.clip(index, 0, len(padded) - 1, out=index)
+        out[start:start + len(position)] = np.einsum("nk,nk->n", phases[position % up], padded[index])
+    return out
+
+
+def normalize(samples, sample_rate, target_dbfs=-20.0, peak_dbfs=-1.0, block_seconds=0.4, gate_dbfs=-70.0):
+    '''
+    Scale a clip so its loudness is target_dbfs, measured as the mean power of 400ms blocks
+    above an absolute gate like EBU R128 (without the K weighting). The gain is capped so the peak stays at peak_dbfs.
+    '''
+    if not len(samples):
+        return samples
+    block = max(1, int(block_seconds * sample_rate))
+    whole = len(samples) - len(samples) % block
+    if whole:
+        powers = np.mean(samples[:whole].reshape(-1, block) ** 2, axis=1)
+    else:
+        powers = np.array([np.mean(samples ** 2)])
+    gated = powers[powers > 10 ** (gate_dbfs / 10)]
+    if not len(gated):
+        # silence, nothing to bring up
+        return samples
+    gain = 10 ** ((target_dbfs - 10 * np.log10(np.mean(gated))) / 20)
+    peak = np.max(np.abs(samples))
+    gain = min(gain, 10 ** (peak_dbfs / 20) / peak)
+    return samples * gain
+
+
+def fade(samples, sample_rate, seconds=0.01):
+    """Raised cosine fade in and out over seconds at each end."""
+    count = min(int(seconds * sample_rate), len(samples) // 2)
+    if count:
+        ramp = 0.5 - 0.5 * np.cos(np.pi * np.arange(count) / count)
+        samples[:count] *= ramp
+        samples[len(samples) - count:] *= ramp[::-1]
+    return samples
+
+
+def to_pcm16(samples):
+    return np.clip(np.round(samples * 32767), -32768, 32767).astype("<i2").tobytes()
+
+
+class AssetPreparer():
+    '''
+    Makes the 48kHz mono 16 bit copy of each asset in cache_dir, named by the source's content digest and
+    the pipeline settings, so it is made once and survives restarts of a server that keeps cache_dir.
+    '''
+    def __init__(self, cache_dir=".prepared_audio", sample_rate=48000, target_dbfs=-20.0, peak_dbfs=-1.0,
+                 fade_seconds=0.01):
+        self.cache_dir = cache_dir
+        self.sample_rate = sample_rate
+        self.target_dbfs = target_dbfs
+        self.peak_dbfs = peak_dbfs
+        self.fade_seconds = fade_seconds
+        settings = (PREPARE_VERSION, sample_rate, target_dbfs, peak_dbfs, fade_seconds)
+        self.tag = hashlib.sha256(repr(settings).encode()).hexdigest()[:8]
+        self._lock = threading.Lock()
+        self._path_locks = {}
+
+    def path(self, file_path, digest):
+        stem = os.path.splitext(os.path.basename(file_path))[0]
+        return os.path.join(self.cache_dir, f"{stem}-{digest[:16]}-{self.tag}.wav")
+
+    def prepare(self, file_path, digest):
+        """Path of the prepared copy of file_path, whose sha256 is digest, making it on the first call."""
+        prepared = self.path(file_path, digest)
+        with self._lock:
+            path_lock = self._path_locks.setdefault(prepared, threading.Lock())
+        with path_lock:
+            if os.path.exists(prepared):
+                return prepared
+            started = time.monotonic()
+            samples, rate = read_wav(file_path)
+            mono = resample(downmix(samples), rate, self.sample_rate)
+            mono = fade(normalize(mono, self.sample_rate, self.target_dbfs, self.peak_dbfs),
+                        self.sample_rate, self.fade_seconds)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # written aside and renamed, so another replica sharing cache_dir never reads half a file
+            partial = f"{prepared}.{uuid.uuid4().hex[:8]}.tmp"
+            with wave.open(partial, "wb") as wav:
+                wav.setnchannels(1)
+                wav.setsampwidth(2)
+                wav.setframerate(self.sample_rate)
+                wav.writeframes(to_pcm16(mono))
+            os.replace(partial, prepared)
+            logger.info("prepared %s (%d Hz, %d channels) as %s in %.2fs", file_path, rate, samples.shape[1],
+                        prepared, time.monotonic() - started)
+            return prepared
@@ -1,74 +1,540 @@
+import asyncio
 from concurrent import futures
+import functools
 import logging
+import math
+import os
+import signal
+import threading
+import time
 import grpc
+from grpc_health.v1 import health, health_pb2, health_pb2_grpc
 import comms_pb2
 import comms_pb2_grpc
-from device_manager import DeviceManager
+from device_manager import DeviceManager, AUDIO_FILENAMES
+from session_registry import SessionRegistry
+from state_store import open_state_store
+from packet_cache import AudioPacketCache
+from pacing import Pacer, TimerWheel
+from broadcast import BroadcastHub, BroadcastProducer, Subscriber
+from control import AudioCommand
+from bitrate import BitrateController
+from ingest import Recorder
+from events import EventDispatcher
+from warmup import warm_assets
+from batch_encode import BatchEncoder
+from packet_pack import PacketPack
+import metrics
 import audio
 
-# this is the reference file for encoding settings, it is not played
-# probably add a whole class later to do all the audio codec bits
-sound_filename = 'startup_mode.wav'
-sound_buffer = audio.wave.open(sound_filename, 'rb')
-samples_per_second = sound_buffer.getframerate()
-# Print debugging information about the wave file
-print(f"Wave file debugging information:")
-print(f"  Sample rate: {samples_per_second} Hz")
-print(f"  Channels: {sound_buffer.getnchannels()}")
-print(f"  Sample width: {sound_buffer.getsampwidth()} bytes")
-print(f"  Total frames: {sound_buffer.getnframes()}")
-print(f"  Compression type: {sound_buffer.getcomptype()}")
-print(f"  Duration: {sound_buffer.getnframes() / samples_per_second:.2f} seconds")
+logger = logging.getLogger(__name__)
+
+# the encoders run at 48kHz mono, assets in any other format are converted by preprocess.py
+samples_per_second = 48000
 desired_frame_duration = 20/1000 # 20ms in seconds
 desired_frame_size = int(desired_frame_duration * samples_per_second)
-sound_buffer.close()
+
+# health service names: readiness is the overall "" status and the DeviceService, both SERVING once warmup is done.
+# liveness is SERVING as soon as the server is up, so a slow warmup doesn't get the pod restarted
+DEVICE_SERVICE = comms_pb2.DESCRIPTOR.services_by_name["DeviceService"].full_name
+READY_SERVICES = ("", DEVICE_SERVICE)
+LIVENESS_SERVICE = "liveness"
+
+# frame durations Opus can encode, in microseconds
+OPUS_FRAME_DURATIONS_US = (2500, 5000, 10000, 20000, 40000, 60000)
+MAX_FRAMES_PER_PACKET = 50
+# most audio a Mode press sends ahead, whatever the device asks for
+MAX_PREROLL_SECONDS = 1.0
+
+
+def negotiate_audio_format(request):
+    '''
+    Read the frame duration and batching a device asked for in its AudioStreamRequest.
+    Returns (frame duration in seconds, frames per packet), unset fields fall back to one 20ms frame per packet.
+    '''
+    frame_duration_us = request.frame_duration_us or int(desired_frame_duration * 1_000_000)
+    if frame_duration_us not in OPUS_FRAME_DURATIONS_US:
+        raise ValueError(f"frame_duration_us must be one of {OPUS_FRAME_DURATIONS_US}, got {frame_duration_us}")
+    frames_per_packet = request.frames_per_packet or 1
+    if frames_per_packet > MAX_FRAMES_PER_PACKET:
+        raise ValueError(f"frames_per_packet must be at most {MAX_FRAMES_PER_PACKET}, got {frames_per_packet}")
+    return frame_duration_us / 1_000_000, frames_per_packet
+
+
+def audio_packet(clip, frames, seq, is_start=False, resume_token=""):
+    '''
+    Build an AudioPacket carrying a batch of Opus frames of clip, the first of which is frame seq.
+    A single frame goes in data, so clients that never ask for batching see the same packets as before.
+    Frames may be memoryviews into a packet pack, protobuf only takes bytes so they are copied here, into the message.
+    The packets holding the clip's first and last frames carry its skip_samples and trim_samples.
+    '''
+    packet = comms_pb2.AudioPacket(is_start=is_start, is_end=False, seq=seq,
+                                   timestamp_us=round(seq * clip.frame_duration * 1_000_000), resume_token=resume_token)
+    if len(frames) <= 1:
+        packet.data = bytes(frames[0]) if frames else b''
+    else:
+        packet.frames.extend(bytes(frame) for frame in frames)
+    if frames and seq == 0:
+        packet.skip_samples = clip.skip_samples
+    if frames and seq + len(frames) == len(clip.packets):
+        packet.trim_samples = clip.trim_samples
+    return packet
+
+
+def start_packet(packet):
+    """Copy of a shared packet marked as the start of a clip."""
+    start = comms_pb2.AudioPacket()
+    start.CopyFrom(packet)
+    start.is_start = True
+    return start
+
+
+def clip_batches(clip, frames_per_packet, first_seq=0):
+    '''
+    Yield a clip as (seq, frames) batches from frame first_seq on, seq indexes straight into the packet list.
+    The slices are made as the batches are sent, a clip from a packet pack never has all its packets as objects at once.
+    '''
+    packets = clip.packets
+    for seq in range(first_seq, len(packets), frames_per_packet):
+        yield seq, packets[seq:seq + frames_per_packet]
+
+
+def clip_token(filename, clip):
+    """Name one encoding of one version of a clip, handed to the device so it can resume after a reconnect."""
+    return f"{filename}:{clip.digest[:16]}:{round(clip.frame_duration * 1_000_000)}"
+
+
+def ladder_clip(packet_cache, filename, clip, bitrate):
+    '''
+    Move a playing clip to another rung of the bitrate ladder if that encode is already cached.
+    Otherwise start encoding it in the background and stay on the current rung, a stream never waits for an encode.
+    '''
+    other = packet_cache.peek(filename, clip.frame_duration, bitrate)
+    if other is None or len(other.packets) != len(clip.packets):
+        packet_cache.warm(filename, clip.frame_duration, bitrate)
+        return clip
+    return other
+
+
+def resume_point(request, packet_cache, frame_duration):
+    '''
+    Where a reconnecting device left off: (filename, clip, first frame it needs), or None to wait for a play as usual.
+    The resume is dropped if the token names a file we don't serve, or the clip was re-encoded
+    or changed on disk since, because seq would then point at different audio.
+    '''
+    if not request.resume_token:
+        return None
+    filename = request.resume_token.rsplit(":", 2)[0]
+    if filename not in AUDIO_FILENAMES:
+        logger.warning("ignoring resume token for unknown clip %r", request.resume_token)
+        return None
+    clip = packet_cache.get(filename, frame_duration)
+    if clip_token(filename, clip) != request.resume_token or request.resume_seq >= len(clip.packets):
+        logger.info("clip %s changed or finished, not resuming", filename)
+        return None
+    return filename, clip, request.resume_seq
+
+
+def preroll_packets(filename, clip, frames_per_packet, preroll_frames):
+    '''
+    Provisional packets with the first preroll_frames of a clip, rounded up to whole packets, sent when a
+    Mode press selects it. Returns the packets and the seq a Play of the same clip carries on from.
+    '''
+    preroll_frames = min(preroll_frames, int(MAX_PREROLL_SECONDS / clip.frame_duration), len(clip.packets))
+    packets = []
+    next_seq = 0
+    for seq in range(0, preroll_frames, frames_per_packet):
+        frames = clip.packets[seq:seq + frames_per_packet]
+        packet = audio_packet(clip, frames, seq, is_start=seq == 0,
+                              resume_token=clip_token(filename, clip) if seq == 0 else "")
+        packet.provisional = True
+        packets.append(packet)
+        next_seq = seq + len(frames)
+    return packets, next_seq
+
+
+def preroll_seq(preroll, filename, clip):
+    '''
+    Frame a Play of clip starts from: where the pre-roll left off if the device holds one of this clip,
+    from the start otherwise. preroll is (filename, clip token, next seq) or None.
+    '''
+    if preroll is None:
+        return 0
+    if preroll[0] == filename and preroll[1] == clip_token(filename, clip):
+        metrics.PREROLLS.inc(outcome="played")
+        return preroll[2]
+    metrics.PREROLLS.inc(outcome="discarded")
+    return 0
+
+
+def lead_packets(lead_frames, frame_duration, frames_per_packet):
+    """Convert a lead of 20ms reference frames into a number of negotiated packets."""
+    return max(1, math.ceil(lead_frames * desired_frame_duration / (frame_duration * frames_per_packet)))
+
+
+def broadcast_start(request, sessions):
+    '''
+    Validate a BroadcastRequest, pick the sessions it goes to and the time.monotonic() it starts at.
+    Raises ValueError for a mode there is no clip for.
+    '''
+    if not 1 <= request.mode < len(AUDIO_FILENAMES):
+        raise ValueError(f"no clip for mode {request.mode}")
+    if request.device_ids:
+        targets = [session for session in map(sessions.get, request.device_ids) if session is not None]
+    else:
+        targets = sessions.all()
+    return targets, time.monotonic() + (request.start_delay_ms or 250) / 1000
+
+
+def broadcast_producer(timer_wheel, clip, frames_per_packet, lead, start_time):
+    """Build the producer for one broadcast, each packet is built once and shared by every subscriber."""
+    pacer = Pacer(timer_wheel, clip.frame_duration * frames_per_packet, lead, start=start_time)
+    return BroadcastProducer([(frames, audio_packet(clip, frames, seq))
+                              for seq, frames in clip_batches(clip, frames_per_packet)], pacer)
+
+
+class Send():
+    """Step: hand packet to gRPC. The step is over once gRPC has taken it, so a slow link makes it a slow step."""
+    def __init__(self, packet):
+        self.packet = packet
+
+
+class WaitCommand():
+    """Step: wait for the next command posted to the device's control channel, None if the stream went away."""
+    def __init__(self, control):
+        self.control = control
+
+    def run(self, cancelled):
+        return self.control.wait(cancelled=cancelled)
+
+    async def async_run(self):
+        return await self.control.wait()
+
+
+class WaitUntil():
+    """Step: wait for the release time of packet index of a paced clip."""
+    def __init__(self, pacer, index):
+        self.pacer = pacer
+        self.index = index
+
+    def run(self, cancelled):
+        self.pacer.wait(self.index)
+
+    async def async_run(self):
+        await self.pacer.async_wait(self.index)
+
+
+class WaitBroadcast():
+    """Step: wait up to timeout for the next (frames, packet) of a broadcast, None if there wasn't one."""
+    def __init__(self, subscriber, timeout):
+        self.subscriber = subscriber
+        self.timeout = timeout
+
+    def run(self, cancelled):
+        return self.subscriber.get(timeout=self.timeout)
+
+    async def async_run(self):
+        return await self.subscriber.get(timeout=self.timeout)
+
+
+class Call():
+    """Step: call function, which may block on a file read or an encode. The grpc.aio server runs it in the executor."""
+    def __init__(self, function, *args):
+        self.function = function
+        self.args = args
+
+    def run(self, cancelled):
+        return self.function(*self.args)
+
+    async def async_run(self):
+        return await asyncio.get_running_loop().run_in_executor(None, self.function, *self.args)
+
+
+class AudioStream():
+    '''
+    One device's ServerAudioStream, the same for the threaded and the grpc.aio server.
+
+    steps() is a generator of the steps above. The server does each one its own way, blocking a worker thread
+    or awaiting on the loop, and sends back the result, see run_steps and server_async.async_run_steps.
+    Everything else, which command does what, pacing, pre-roll, broadcasts, bitrate and metrics, lives here once.
+    subscriber_factory makes the broadcast Subscriber that suits the server.
+    '''
+    def __init__(self, servicer, device_manager, request, frame_duration, frames_per_packet, subscriber_factory):
+        self.servicer = servicer
+        self.device_manager = device_manager
+        self.control = device_manager.control
+        self.request = request
+        self.frame_duration = frame_duration
+        self.frames_per_packet = frames_per_packet
+        self.subscriber_factory = subscriber_factory
+        self.bitrate = BitrateController(frame_duration * frames_per_packet)
+        # the pre-roll the device is holding, (filename, clip token, next seq)
+        self.preroll = None
+
+    def steps(self):
+        logger.info("Server received audio stream request from %s: %s", self.device_manager.device_id, self.request)
+        if not self.request.start:
+            return
+        logger.debug("Waiting for play event...")
+        resume = yield Call(resume_point, self.request, self.servicer.packet_cache, self.frame_duration)
+        # a reconnect in the middle of a clip carries on from the first frame the device is missing
+        command = AudioCommand("resume") if resume is not None else None
+        while True:
+            if command is None:
+                command = yield WaitCommand(self.control)
+                if command is None:
+                    logger.debug("audio stream for %s cancelled", self.device_manager.device_id)
+                    return
+            if command.kind == "mode":
+                yield from self.select(command)
+                command = None
+            elif command.kind == "stop":
+                logger.debug("Server received Stop event, but not currently streaming")
+                command = None
+                if self.preroll is not None:
+                    self.discard_preroll()
+                    yield Send(comms_pb2.AudioPacket(is_end=True, provisional=True))
+            elif command.kind == "broadcast":
+                self.discard_preroll()
+                command = yield from self.broadcast(command)
+            elif command.kind in ("play", "resume"):
+                # a play that interrupted the clip starts the next one on the next pass
+                command = yield from self.play(command, resume)
+            else:
+                command = None
+
+    def select(self, select):
+        """A Mode press: cache the clip Play is likely to want next, and send its pre-roll if the device asked for one."""
+        filename = self.device_manager.audio_filenames[select.mode]
+        clip = yield Call(self.servicer.packet_cache.get, filename, self.frame_duration, self.bitrate.bitrate)
+        if not self.request.preroll_frames:
+            return
+        # a new provisional start replaces whatever pre-roll the device has
+        self.discard_preroll()
+        packets, next_seq = preroll_packets(filename, clip, self.frames_per_packet, self.request.preroll_frames)
+        for packet in packets:
+            yield Send(packet)
+            self.sent(packet)
+        self.preroll = (filename, clip_token(filename, clip), next_seq)
+
+    def discard_preroll(self):
+        if self.preroll is not None:
+            metrics.PREROLLS.inc(outcome="discarded")
+            self.preroll = None
+
+    def play(self, play, resume):
+        '''
+        Stream the clip a play or resume command asks for, paced on the media clock, then its end packet.
+        Returns the play or broadcast command that interrupted it, or None.
+        '''
+        packet_cache = self.servicer.packet_cache
+        frames_per_packet = self.frames_per_packet
+        if play.kind == "resume":
+            filename, clip, first_seq = resume
+            logger.info("Resuming %s for %s at frame %d", filename, self.device_manager.device_id, first_seq)
+        else:
+            logger.debug("Play event received, starting audio stream for %s", self.device_manager.device_id)
+            filename = self.device_manager.audio_filenames[play.mode]
+            # a stream that was congested in its last clip starts the next one at the lower rate
+            clip = yield Call(packet_cache.get, filename, self.frame_duration, self.bitrate.bitrate)
+            first_seq = preroll_seq(self.preroll, filename, clip)
+        self.preroll = None
+        batches = clip_batches(clip, frames_per_packet, first_seq)
+        if clip.bitrate is not None and self.bitrate.rung > 0:
+            # have the next rung down ready in case the link gets worse
+            packet_cache.warm(filename, clip.frame_duration, self.bitrate.ladder[self.bitrate.rung - 1])
+
+        # Send start packet, the first packet carries audio when there is any and the token to resume the clip.
+        # A resumed clip isn't marked as a start, the device keeps what it has buffered
+        seq, frames = next(batches, (first_seq, []))
+        packet = audio_packet(clip, frames, seq, is_start=first_seq == 0, resume_token=clip_token(filename, clip))
+        yield Send(packet)
+        next_seq = seq + len(frames)
+        if play.kind == "play":
+            metrics.PLAY_TO_FIRST_PACKET.observe(time.monotonic() - play.posted_at)
+        self.sent(packet)
+
+        # Send all following packets, they are already encoded
+        pacer = Pacer(self.servicer.timer_wheel, clip.frame_duration * frames_per_packet,
+                      lead_packets(self.servicer.lead_frames, clip.frame_duration, frames_per_packet))
+        command = None
+        for index, (seq, frames) in enumerate(batches, start=1):
+            yield WaitUntil(pacer, index)
+            command = self.control.poll()
+            if command is not None and command.kind in ("stop", "play", "broadcast"):
+                logger.debug("%s received, stopping audio stream", command.kind)
+                break
+            if command is not None and command.kind == "mode":
+                # no pre-roll over a playing clip, just have the selected one cached for the next Play
+                packet_cache.warm(self.device_manager.audio_filenames[command.mode], clip.frame_duration,
+                                  self.bitrate.bitrate)
+            command = None
+
+            if clip.bitrate is not None and clip.bitrate != self.bitrate.bitrate:
+                clip = ladder_clip(packet_cache, filename, clip, self.bitrate.bitrate)
+                frames = clip.packets[seq:seq + frames_per_packet]
+            packet = audio_packet(clip, frames, seq)
+            sent = time.monotonic()
+            yield Send(packet)
+            self.bitrate.observe(pacer.lag(index, sent), time.monotonic() - sent)
+            next_seq = seq + len(frames)
+            self.sent(packet)
+
+        # Send end packet
+        yield Send(comms_pb2.AudioPacket(is_start=False, is_end=True, data=b'', seq=next_seq,
+                                         timestamp_us=round(next_seq * clip.frame_duration * 1_000_000)))
+        logger.debug("Server sent end packet")
+        if command is not None and command.kind == "stop":
+            metrics.STOP_TO_LAST_PACKET.observe(time.monotonic() - command.posted_at)
+            command = None
+        return command
+
+    def broadcast(self, broadcast):
+        '''
+        Stream one broadcast to the device from its shared producer.
+        Returns the command that interrupted it, or None if it played to the end.
+        '''
+        filename = self.device_manager.audio_filenames[broadcast.mode]
+        clip = yield Call(self.servicer.packet_cache.get, filename, self.frame_duration)
+        frames_per_packet = self.frames_per_packet
+        lead = lead_packets(self.servicer.lead_frames, clip.frame_duration, frames_per_packet)
+        subscriber = self.subscriber_factory()
+        producer = self.servicer.broadcasts.subscribe(
+            (filename, clip.frame_duration, frames_per_packet, broadcast.start_time),
+            lambda: broadcast_producer(self.servicer.timer_wheel, clip, frames_per_packet, lead, broadcast.start_time),
+            subscriber)
+        command = None
+        started = False
+        try:
+            while not subscriber.finished:
+                # wake at least once a packet so a stop is seen while waiting for the start time
+                item = yield WaitBroadcast(subscriber, clip.frame_duration * frames_per_packet)
+                command = self.control.poll()
+                if command is not None and command.kind in ("stop", "play", "broadcast"):
+                    logger.debug("%s received, leaving broadcast", command.kind)
+                    break
+                command = None
+                if item is None:
+                    continue
+                _, packet = item
+                # the shared packets aren't marked as a start, the first one this device gets is rebuilt
+                yield Send(start_packet(packet) if not started else packet)
+                if not started:
+                    metrics.PLAY_TO_FIRST_PACKET.observe(time.monotonic() - broadcast.posted_at)
+                    started = True
+                self.sent(packet)
+        finally:
+            producer.remove(subscriber)
+        if started:
+            yield Send(comms_pb2.AudioPacket(is_start=False, is_end=True, data=b''))
+        if subscriber.dropped:
+            logger.info("device %s dropped %d broadcast packets", self.device_manager.device_id, subscriber.dropped)
+        if command is not None and command.kind == "stop":
+            metrics.STOP_TO_LAST_PACKET.observe(time.monotonic() - command.posted_at)
+            command = None
+        return command
+
+    def sent(self, packet):
+        metrics.PACKETS_SENT.inc()
+        metrics.BYTES_SENT.inc(len(packet.data) + sum(len(frame) for frame in packet.frames))
+
+
+def run_steps(steps, cancelled):
+    """Drive AudioStream.steps() on a worker thread, yielding its packets to gRPC until it ends or cancelled is set."""
+    try:
+        result = None
+        while True:
+            step = steps.send(result)
+            result = None
+            if isinstance(step, Send):
+                yield step.packet
+                continue
+            result = step.run(cancelled)
+            if cancelled.is_set():
+                return
+    except StopIteration:
+        return
+    finally:
+        steps.close()
+
 
 class DeviceServiceServicer(comms_pb2_grpc.DeviceServiceServicer):
-    def __init__(self):
-        self.device_manager = DeviceManager()
-        self.opus_coder = audio.OpusCoder(sample_rate=48000, channels=1)
-        self.device_states = {}
+    def __init__(self, lead_frames=5, state_store=None, recordings_dir="audio_recordings/server", encode_workers=0,
+                 packet_pack=None):
+        # one DeviceManager per device_id, created on first connect,
+        # restoring mode and LEDs from state_store if another replica or an evicted session saved them
+        self.state_store = state_store
+        self.sessions = SessionRegistry(session_factory=functools.partial(DeviceManager, store=state_store),
+                                        store=state_store)
+        self.encoder_pool = audio.OpusEncoderPool(sample_rate=samples_per_second, channels=1)
+        # with encode_workers, cache fills are encoded on that many processes instead of the encoder pool
+        batch_encoder = BatchEncoder(encode_workers) if encode_workers else None
+        # clips precompiled by batch_encode.py are served from the mapped pack, if they match the files on disk
+        pack = PacketPack(packet_pack) if packet_pack else None
+        self.packet_cache = AudioPacketCache(frame_duration=desired_frame_duration, encoder_pool=self.encoder_pool,
+                                             batch_encoder=batch_encoder, pack=pack)
+        # microphone uploads, each stream checks out a decoder for as long as it is open
+        self.decoder_pool = audio.OpusDecoderPool(sample_rate=samples_per_second, channels=1)
+        self.recordings_dir = recordings_dir
+        # audio is sent on the media clock, lead_frames ahead of real time, all streams share one timer thread
+        self.timer_wheel = TimerWheel()
+        self.lead_frames = lead_frames
+        # group playback, one producer per broadcast and format feeds every device's stream
+        self.broadcasts = BroadcastHub()
+        # button handlers run here, EventStream only queues and acks
+        self.events = EventDispatcher()
+        # read at scrape time, nothing to update on the hot path
+        metrics.SESSIONS.function = lambda: len(self.sessions)
+        metrics.BROADCASTS.function = lambda: len(self.broadcasts)
+        metrics.STATUS_PENDING.function = lambda: sum(s.status.pending for s in self.sessions.all())
+        metrics.EVENT_QUEUE_DEPTH.function = self.events.pending
+        # flat through device reconnects as long as every stream gives its worker thread back
+        metrics.THREADS.function = threading.active_count
+
+    def apply_remote_command(self, device_id, kind, state):
+        """A replica handled a command for a device, pass it on if this replica has a session for it too."""
+        device_manager = self.sessions.get(device_id)
+        if device_manager is not None:
+            device_manager.apply_remote(kind, state)
 
     def StatusStream(self, request_iterator, context):
         '''
         Handle device status requests from the client, and return the device status.
         Device connects and listens, send something immediately.
         Set state immediately from DeviceManager to set the status from output proto.
-        On connect, try and get device state from the dictionary, otherwise, make a new device_manager
+        On connect, get the device state from the session registry, which makes a new device_manager the first time
         '''
-        print("Server received status request from client")
-        # Print the metadata
-        metadata = dict(context.invocation_metadata())
-        print(f"Client metadata received: {metadata}")
-        
-        # If you want to specifically access the device_id
-        device_id = metadata.get('device_id', 'unknown')
-        
-        device_manager = self.device_states.get(device_id, self.device_manager)
-        status_set = device_manager.device_status_set(device_manager.leds)
-        device_manager.device_id = device_id
-        print(f"Saved state for device {device_id} with data {repr(device_manager)}")
-        yield comms_pb2.DeviceStatusRequest(set=status_set)
+        logger.info("Server received status request from client, metadata %s", context.invocation_metadata())
+
+        device_manager, stream = self.sessions.open_stream(context, "StatusStream")
+        # a wait for LED changes must not outlive the stream, or it holds a worker thread forever
+        stream.on_cancel(device_manager.status.interrupt)
+        logger.debug("Loaded state for device %s with data %r", device_manager.device_id, device_manager)
+        # a new stream gets every LED, after that only the ones that changed
+        yield device_manager.status_request(device_manager.status.take_all())
 
         # for status_response in request_iterator:
-        #     print(f"Server received status response: {status_response}")
+        #     logger.debug("Server received status response: %s", status_response)
         #     yield comms_pb2.DeviceStatusRequest()
         for request in request_iterator:
             # Maybe look for "error" and handle that as an exception?
-            print(f"Server received request status: {request}")
+            logger.debug("Server received request status: %s", request)
             try:
-                event = self.device_manager.status_queue.get()
+                # presses while the device was answering the last update are merged into this one
+                changed = device_manager.status.wait(cancelled=stream.cancelled)
+                if changed is None:
+                    return
                 # this yield is required as it the first yield because the client needs a response to stop asking if it is connected.
-                yield event
+                yield device_manager.status_request(changed)
                 # perhaps some logic here to handle the GET versus SET logic?
                 # right now I'm assuming only SET from button events.
             # except queue.Empty:
-            #     print(f"Status queue empty. Waiting... ")
+            #     logger.debug("Status queue empty. Waiting... ")
             #     continue
             except grpc.RpcError as e:
-                print(f"RPC error in StatusStream: {e}")
-            except Exception as e:
-                print(f"Error in StatusStream: {e}")
+                logger.warning("RPC error in StatusStream: %s", e)
+            except Exception:
+                logger.exception("Error in StatusStream")
 
     def EventStream(self, request_iterator, context):
         '''
@@ -79,136 +545,170 @@ class DeviceServiceServicer(comms_pb2_grpc.DeviceServiceServicer):
         This is where the async bits could exist.
 
         See function message_generator in client.py for an example of turning a queue into a generator
+
+        Events are now queued on the EventDispatcher and acked with their seq as soon as they are queued,
+        so the client can keep several presses in flight and a slow handler doesn't hold up the acks.
         '''
+        device_manager = self.sessions.attach(context, "EventStream")
         try:
             for request in request_iterator:
-                print(f"Server received event: {request}")
-                if request.button_event.button_id == comms_pb2.ButtonEvent.ButtonId.BUTTON_2:
-                    self.device_manager.handle_mode_event(request)
-                elif request.button_event.button_id == comms_pb2.ButtonEvent.ButtonId.BUTTON_4:
-                    self.device_manager.handle_play_event(request)
-                elif request.button_event.button_id == comms_pb2.ButtonEvent.ButtonId.BUTTON_3:
-                    self.device_manager.handle_stop_event(request)
+                logger.debug("Server received event: %s", request)
+                self.events.submit(device_manager, request)
                 # respond with an ACK to keep the event loop going
-                yield comms_pb2.DeviceEventResponse(ack=True)
+                yield comms_pb2.DeviceEventResponse(ack=True, seq=request.seq)
         except grpc.RpcError as e:
-            print(f"RPC error in EventStream: {e}")
-        except Exception as e:
-            print(f"Error in EventStream: {e}")
+            logger.warning("RPC error in EventStream: %s", e)
+        except Exception:
+            logger.exception("Error in EventStream")
 
     def ServerAudioStream(self, request, context):
         '''
-        Audio stream should have a logic block to look for the start message, 
+        Audio stream should have a logic block to look for the start message,
         which opens the gRPC stream, then waits for a play event, then starts streaming audio.
-        The transport control logic is a bit of a mess, they might be redundantly using a second queue but hey, they work now...
+        The stream sleeps on the device's ControlChannel until a play, stop or mode command is posted,
+        so an idle device costs nothing and a press is picked up immediately.
+        A stop, or a new play, interrupts a clip that is still streaming.
+        A broadcast command subscribes the stream to the shared producer for that broadcast instead of pacing its own copy.
+        A request with a resume token picks up the clip it names at resume_seq, before waiting for commands.
+        A BitrateController watches pacing lag and send time, and moves the stream between cached bitrate encodes.
+        A mode command loads the clip Play will want into the cache. If the device asked for preroll_frames, the
+        start of it is sent marked provisional, and a Play of that clip goes on from where the pre-roll ended.
+        All of that is AudioStream, this handler only runs its steps on the worker thread.
+        '''
+        device_manager, stream = self.sessions.open_stream(context, "ServerAudioStream")
+        control = device_manager.control
+        # remote commands from before this stream opened were applied to an idle session while the device was on
+        # another replica, replaying them would start a clip nobody just pressed. Its own presses are kept
+        control.drop_remote()
+        # the device going away wakes the wait for a command, the stream returns instead of waiting for the next press
+        stream.on_cancel(control.interrupt)
+        try:
+            frame_duration, frames_per_packet = negotiate_audio_format(request)
+        except ValueError as e:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+        audio_stream = AudioStream(self, device_manager, request, frame_duration, frames_per_packet, Subscriber)
+        try:
+            yield from run_steps(audio_stream.steps(), stream.cancelled)
+        except grpc.RpcError as e:
+            logger.warning("RPC error in ServerAudioStream: %s", e)
+        except Exception:
+            logger.exception("Error in ServerAudioStream")
+
+    def ClientAudioStream(self, request_iterator, context):
+        '''
+        Receive microphone audio from the device and record it under recordings_dir/<device_id>.
+        Packets are decoded and written as they arrive, nothing but one flush buffer is held per stream.
         '''
-        import queue
-        
+        device_manager = self.sessions.attach(context, "ClientAudioStream")
         try:
-            print(f"Server received audio stream request: {request}")
-            
-            if request.start:
-                print("Server received start packet")
-                print("Waiting for play event...")
-                
-                # Main loop that watches for play events at 10Hz
-                while True:
-                    try:
-                        # Poll the queue with a 0.1 second timeout (10Hz)
-                        event = self.device_manager.audio_event_queue.get(block=True, timeout=0.1)
-                        
-                        if "play" in event:
-                            if event["play"]:
-                                # Play event received, start streaming audio
-                                print("Play event received, starting audio stream")
-                                sound_buffer = audio.wave.open(
-                                    self.device_manager.audio_filenames[self.device_manager.mode], 'rb')
-                                
-                                # Send start packet with first chunk of audio
-                                first_chunk = sound_buffer.readframes(desired_frame_size)
-                                print(f"Server read first audio chunk {len(first_chunk)} bytes ")
-                                first_opus_data = self.opus_coder.encode(first_chunk)
-                                yield comms_pb2.AudioPacket(
-                                    is_start=True,
-                                    is_end=False,
-                                    data=bytes(first_opus_data)
-                                )
-                                print("Server sent start AudioPacket")
-
-                                # Read and send all following audio data in chunks
-                                streaming = True
-                                while streaming:
-                                    # Check for stop events while streaming
-                                    try:
-                                        stop_event = self.device_manager.audio_event_queue.get(block=False)
-                                        if "play" in stop_event and not stop_event["play"]:
-                                            print("Stop event received, stopping audio stream")
-                                            streaming = False
-                                            break
-                                    except queue.Empty:
-                                        # No stop event, continue streaming
-                                        pass
-                                    
-                                    chunk = sound_buffer.readframes(desired_frame_size)
-                                    if not chunk:
-                                        break
-                                    
-                                    if len(chunk) // 2 == desired_frame_size:
-                                        opus_data = self.opus_coder.encode(chunk)
-                                        print(f"Server read audio chunk {len(chunk)} bytes")
-                                        yield comms_pb2.AudioPacket(
-                                            is_start=False,
-                                            is_end=False,
-                                            data=bytes(opus_data)
-                                        )
-                                    else:
-                                        # Handle partial chunks
-                                        # Convert to bytearray for easier manipulation
-                                        # https://pyogg.readthedocs.io/en/latest/examples.html
-                                        chunk_bytes = bytearray(chunk)
-                                        # Calculate padding needed
-                                        padding_needed = desired_frame_size - (len(chunk_bytes) // 2)
-                                        # Add padding bytes (zeros)
-                                        padded_data = chunk_bytes + b'\x00' * (padding_needed * 2)
-                                        print(f"Server read short audio chunk {len(chunk)} bytes and padded to {len(padded_data)} bytes")
-                                        opus_data = self.opus_coder.encode(padded_data)
-                                        yield comms_pb2.AudioPacket(
-                                            is_start=False,
-                                            is_end=False,
-                                            data=bytes(opus_data)
-                                        )
-
-                                # Send end packet
-                                yield comms_pb2.AudioPacket(
-                                    is_start=False,
-                                    is_end=True,
-                                    data=b''
-                                )
-                                print("Server sent end packet")
-                                
-                                # Close and reset sound buffer
-                                sound_buffer.close()
-                            else:
-                                # Stop event received but not currently streaming
-                                print("Server received Stop event received, but not currently streaming")
-                    except queue.Empty:
-                        # No event in queue, continue polling
-                        continue
-                
+            opus_decoder = self.decoder_pool.acquire(timeout=1.0)
+        except TimeoutError as e:
+            context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, str(e))
+        recorder = Recorder(opus_decoder, self.recordings_dir, device_manager.device_id, samples_per_second)
+        try:
+            for packet in request_iterator:
+                recorder.packet(packet)
         except grpc.RpcError as e:
-            print(f"RPC error in ServerAudioStream: {e}")
-        except Exception as e:
-            print(f"Error in ServerAudioStream: {e}")
+            logger.warning("RPC error in ClientAudioStream: %s", e)
+        finally:
+            # a device that drops mid recording still gets what it sent so far on disk
+            recorder.finish()
+            self.decoder_pool.release(opus_decoder)
+        if recorder.missed_frames:
+            logger.info("device %s upload missed %d frames", device_manager.device_id, recorder.missed_frames)
+        return comms_pb2.ClientAudioResponse(packets=recorder.packets, missed_frames=recorder.missed_frames,
+                                             segments=recorder.segments)
+
+    def Broadcast(self, request, context):
+        '''
+        Post a broadcast command to every targeted device, their audio streams subscribe to it and
+        start together start_delay_ms from now.
+        '''
+        try:
+            targets, start_time = broadcast_start(request, self.sessions)
+        except ValueError as e:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+        for device_manager in targets:
+            device_manager.control.post("broadcast", request.mode, start_time=start_time)
+        logger.info("broadcast of mode %d to %d devices", request.mode, len(targets))
+        return comms_pb2.BroadcastResponse(devices=len(targets))
 
-def serve():
-    port = "50051"
+def warm_up(packet_cache, health_servicer):
+    """Encode the assets into the cache, then report ready. Runs on its own thread after the port is bound."""
+    try:
+        seconds = warm_assets(packet_cache, AUDIO_FILENAMES, desired_frame_duration)
+    except Exception:
+        # a broken asset keeps the pod out of the service instead of failing plays
+        logger.exception("asset warmup failed, staying not ready")
+        return
+    for service in READY_SERVICES:
+        health_servicer.set(service, health_pb2.HealthCheckResponse.SERVING)
+    logger.info("warmup done in %.2fs, ready", seconds)
+
+def serve(port="50051", lead_frames=5, metrics_port=None, state_store="memory", recordings_dir="audio_recordings/server",
+          encode_workers=0, packet_pack=None):
+    if metrics_port:
+        metrics.start_http_server(metrics_port)
     server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
-    comms_pb2_grpc.add_DeviceServiceServicer_to_server(DeviceServiceServicer(), server)
+    store = open_state_store(state_store)
+    servicer = DeviceServiceServicer(lead_frames=lead_frames, state_store=store, recordings_dir=recordings_dir,
+                                     encode_workers=encode_workers, packet_pack=packet_pack)
+    # queue.Queue and ControlChannel are thread safe, remote commands are applied straight from the store thread
+    store.subscribe(servicer.apply_remote_command)
+    servicer.sessions.start_reaper()
+    comms_pb2_grpc.add_DeviceServiceServicer_to_server(servicer, server)
+    health_servicer = health.HealthServicer()
+    health_servicer.set(LIVENESS_SERVICE, health_pb2.HealthCheckResponse.SERVING)
+    for service in READY_SERVICES:
+        health_servicer.set(service, health_pb2.HealthCheckResponse.NOT_SERVING)
+    health_pb2_grpc.add_HealthServicer_to_server(health_servicer, server)
     server.add_insecure_port("[::]:" + port)
     server.start()
-    print("Server started, listening on " + port)
-    server.wait_for_termination()
+    logger.info("Server started, listening on %s", port)
+    threading.Thread(target=warm_up, args=(servicer.packet_cache, health_servicer), name="warmup", daemon=True).start()
+
+    def shutdown(signum, frame):
+        # stop taking RPCs, then wake the streams waiting on a press so they return within the grace period
+        logger.info("received signal %d, shutting down", signum)
+        health_servicer.enter_graceful_shutdown()
+        server.stop(grace=5)
+        logger.info("ended %d open streams", servicer.sessions.cancel_streams())
+    signal.signal(signal.SIGTERM, shutdown)
+    try:
+        server.wait_for_termination()
+    finally:
+        health_servicer.enter_graceful_shutdown()
+        servicer.events.close()
+        servicer.packet_cache.close()
+        store.close()
 
 if __name__ == "__main__":
-    logging.basicConfig()
-    serve()
\ No newline at end of file
+    import argparse
+    parser = argparse.ArgumentParser(description="Device gRPC server")
+    parser.add_argument("--port", default="50051")
+    parser.add_argument("--lead-frames", type=int, default=5,
+                        help="number of 20ms frames of audio sent ahead of real time when a clip starts")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve Prometheus text metrics on this port at /metrics")
+    parser.add_argument("--log-level", default="INFO", help="DEBUG logs every event and status update")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="run the grpc.aio server from server_async.py instead of the thread pool server")
+    parser.add_argument("--state-store", default=os.environ.get("DEVICE_STATE_STORE", "memory"),
+                        help="where device mode and LEDs are kept: memory, or sqlite:///path/to/state.db "
+                             "to share them between replicas (default from DEVICE_STATE_STORE)")
+    parser.add_argument("--recordings-dir", default="audio_recordings/server",
+                        help="where microphone uploads from ClientAudioStream are written, one directory per device")
+    parser.add_argument("--encode-workers", type=int, default=0,
+                        help="encode assets on this many processes, split into segments, 0 encodes on the server process")
+    parser.add_argument("--packet-pack", default=None,
+                        help="map this pack from batch_encode.py and serve the clips in it instead of encoding them")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    if args.use_async:
+        import asyncio
+        import server_async
+        asyncio.run(server_async.serve(args.port, args.lead_frames, args.metrics_port, args.state_store,
+                                       args.recordings_dir, args.encode_workers, args.packet_pack))
+    else:
+        serve(args.port, args.lead_frames, args.metrics_port, args.state_store, args.recordings_dir,
+              args.encode_workers, args.packet_pack)
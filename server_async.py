@@ -0,0 +1,241 @@
+import asyncio
+import functools
+import logging
+import signal
+import threading
+
+import grpc
+from grpc_health.v1 import health, health_pb2, health_pb2_grpc
+import comms_pb2
+import comms_pb2_grpc
+import audio
+from device_manager import DeviceManager, AUDIO_FILENAMES
+from packet_cache import AudioPacketCache
+from session_registry import SessionRegistry
+from state_store import open_state_store
+from pacing import TimerWheel
+from broadcast import BroadcastHub, AsyncSubscriber
+from control import AsyncControlChannel, AsyncStatusChannel
+import metrics
+from ingest import AsyncRecorder, Recorder
+from events import run_events
+from warmup import warm_assets
+from batch_encode import BatchEncoder
+from packet_pack import PacketPack
+from server import (desired_frame_duration, samples_per_second, negotiate_audio_format, broadcast_start,
+                    AudioStream, Send, READY_SERVICES, LIVENESS_SERVICE)
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncDeviceServiceServicer(comms_pb2_grpc.DeviceServiceServicer):
+    '''
+    grpc.aio version of DeviceServiceServicer in server.py, same messages on the wire.
+    Every stream is an async generator waiting on an asyncio.Queue or event, so an idle device costs
+    a suspended coroutine instead of a worker thread.
+    '''
+    def __init__(self, lead_frames=5, state_store=None, recordings_dir="audio_recordings/server", encode_workers=0,
+                 packet_pack=None):
+        self.state_store = state_store
+        self.sessions = SessionRegistry(session_factory=functools.partial(
+            DeviceManager, status_factory=AsyncStatusChannel, control_factory=AsyncControlChannel, store=state_store),
+            store=state_store)
+        self.encoder_pool = audio.OpusEncoderPool(sample_rate=samples_per_second, channels=1)
+        batch_encoder = BatchEncoder(encode_workers) if encode_workers else None
+        pack = PacketPack(packet_pack) if packet_pack else None
+        self.packet_cache = AudioPacketCache(frame_duration=desired_frame_duration, encoder_pool=self.encoder_pool,
+                                             batch_encoder=batch_encoder, pack=pack)
+        self.decoder_pool = audio.OpusDecoderPool(sample_rate=samples_per_second, channels=1)
+        self.recordings_dir = recordings_dir
+        self.timer_wheel = TimerWheel()
+        self.lead_frames = lead_frames
+        self.broadcasts = BroadcastHub()
+        # each EventStream's queue, for the depth metric
+        self.event_queues = set()
+        metrics.SESSIONS.function = lambda: len(self.sessions)
+        metrics.THREADS.function = threading.active_count
+        metrics.BROADCASTS.function = lambda: len(self.broadcasts)
+        metrics.STATUS_PENDING.function = lambda: sum(s.status.pending for s in self.sessions.all())
+        metrics.EVENT_QUEUE_DEPTH.function = lambda: sum(events.qsize() for events in self.event_queues)
+
+    def apply_remote_command(self, device_id, kind, state):
+        """Same as DeviceServiceServicer.apply_remote_command, must run on the event loop."""
+        device_manager = self.sessions.get(device_id)
+        if device_manager is not None:
+            device_manager.apply_remote(kind, state)
+
+    async def StatusStream(self, request_iterator, context):
+        '''
+        Send the current LED state as the primed response, then per client response one status SET
+        with the LEDs that changed since.
+        '''
+        logger.info("Server received status request from client, metadata %s", context.invocation_metadata())
+
+        device_manager = await self.sessions.async_attach(context, "StatusStream")
+        yield device_manager.status_request(device_manager.status.take_all())
+
+        try:
+            async for request in request_iterator:
+                logger.debug("Server received request status: %s", request)
+                yield device_manager.status_request(await device_manager.status.wait())
+        except grpc.RpcError as e:
+            logger.warning("RPC error in StatusStream: %s", e)
+
+    async def EventStream(self, request_iterator, context):
+        '''
+        Queue each button event for this stream's worker task and ack it with its seq once queued.
+        The queue is bounded, a device pressing faster than its events are handled waits for room before the ack.
+        '''
+        device_manager = await self.sessions.async_attach(context, "EventStream")
+        events = asyncio.Queue(256)
+        self.event_queues.add(events)
+        worker = asyncio.create_task(run_events(events, device_manager))
+        try:
+            async for request in request_iterator:
+                logger.debug("Server received event: %s", request)
+                await events.put(request)
+                yield comms_pb2.DeviceEventResponse(ack=True, seq=request.seq)
+        except grpc.RpcError as e:
+            logger.warning("RPC error in EventStream: %s", e)
+        finally:
+            self.event_queues.discard(events)
+            # events already acked are still handled, the worker stops once it reaches the None
+            if not worker.done():
+                await events.put(None)
+
+    async def ServerAudioStream(self, request, context):
+        '''
+        Run the device's AudioStream, see DeviceServiceServicer.ServerAudioStream. Waits are awaited on the loop
+        and anything that may block on a file read or an encode goes to the executor.
+        '''
+        device_manager = await self.sessions.async_attach(context, "ServerAudioStream")
+        control = device_manager.control
+        # remote commands queued before the stream opened are stale, see DeviceServiceServicer.ServerAudioStream
+        control.drop_remote()
+        try:
+            frame_duration, frames_per_packet = negotiate_audio_format(request)
+        except ValueError as e:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+        audio_stream = AudioStream(self, device_manager, request, frame_duration, frames_per_packet, AsyncSubscriber)
+        try:
+            async for packet in async_run_steps(audio_stream.steps()):
+                yield packet
+        except grpc.RpcError as e:
+            logger.warning("RPC error in ServerAudioStream: %s", e)
+        except Exception:
+            logger.exception("Error in ServerAudioStream")
+
+    async def ClientAudioStream(self, request_iterator, context):
+        '''
+        Record the device's microphone upload, see DeviceServiceServicer.ClientAudioStream.
+        Decoding and writing happen in the executor through an AsyncRecorder.
+        '''
+        device_manager = await self.sessions.async_attach(context, "ClientAudioStream")
+        try:
+            opus_decoder = self.decoder_pool.acquire(timeout=0)
+        except TimeoutError as e:
+            await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, str(e))
+        recorder = Recorder(opus_decoder, self.recordings_dir, device_manager.device_id, samples_per_second)
+        queued = AsyncRecorder(recorder)
+        try:
+            async for packet in request_iterator:
+                await queued.packet(packet)
+        except grpc.RpcError as e:
+            logger.warning("RPC error in ClientAudioStream: %s", e)
+        finally:
+            try:
+                await queued.finish()
+            finally:
+                self.decoder_pool.release(opus_decoder)
+        if recorder.missed_frames:
+            logger.info("device %s upload missed %d frames", device_manager.device_id, recorder.missed_frames)
+        return comms_pb2.ClientAudioResponse(packets=recorder.packets, missed_frames=recorder.missed_frames,
+                                             segments=recorder.segments)
+
+    async def Broadcast(self, request, context):
+        '''
+        Post a broadcast command to every targeted device, see DeviceServiceServicer.Broadcast.
+        '''
+        try:
+            targets, start_time = broadcast_start(request, self.sessions)
+        except ValueError as e:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+        for device_manager in targets:
+            device_manager.control.post("broadcast", request.mode, start_time=start_time)
+        logger.info("broadcast of mode %d to %d devices", request.mode, len(targets))
+        return comms_pb2.BroadcastResponse(devices=len(targets))
+
+
+
+async def async_run_steps(steps):
+    """run_steps for the grpc.aio server, the stream ends when the task is cancelled."""
+    try:
+        result = None
+        while True:
+            step = steps.send(result)
+            result = None
+            if isinstance(step, Send):
+                yield step.packet
+                continue
+            result = await step.async_run()
+    except StopIteration:
+        return
+    finally:
+        steps.close()
+
+async def reap_sessions(sessions, interval=60):
+    while True:
+        await asyncio.sleep(interval)
+        sessions.evict_idle()
+
+
+async def warm_up(packet_cache, health_servicer):
+    """Same as server.warm_up, the encodes run in the executor."""
+    loop = asyncio.get_running_loop()
+    try:
+        seconds = await loop.run_in_executor(None, warm_assets, packet_cache, AUDIO_FILENAMES, desired_frame_duration)
+    except Exception:
+        logger.exception("asset warmup failed, staying not ready")
+        return
+    for service in READY_SERVICES:
+        await health_servicer.set(service, health_pb2.HealthCheckResponse.SERVING)
+    logger.info("warmup done in %.2fs, ready", seconds)
+
+
+async def serve(port="50051", lead_frames=5, metrics_port=None, state_store="memory", recordings_dir="audio_recordings/server",
+                encode_workers=0, packet_pack=None):
+    if metrics_port:
+        metrics.start_http_server(metrics_port)
+    server = grpc.aio.server()
+    store = open_state_store(state_store)
+    servicer = AsyncDeviceServiceServicer(lead_frames=lead_frames, state_store=store, recordings_dir=recordings_dir,
+                                          encode_workers=encode_workers, packet_pack=packet_pack)
+    # asyncio.Queue and AsyncControlChannel aren't thread safe, hop from the store thread onto the loop
+    loop = asyncio.get_running_loop()
+    store.subscribe(lambda *command: loop.call_soon_threadsafe(servicer.apply_remote_command, *command))
+    comms_pb2_grpc.add_DeviceServiceServicer_to_server(servicer, server)
+    health_servicer = health.aio.HealthServicer()
+    await health_servicer.set(LIVENESS_SERVICE, health_pb2.HealthCheckResponse.SERVING)
+    for service in READY_SERVICES:
+        await health_servicer.set(service, health_pb2.HealthCheckResponse.NOT_SERVING)
+    health_pb2_grpc.add_HealthServicer_to_server(health_servicer, server)
+    reaper = asyncio.create_task(reap_sessions(servicer.sessions))
+    server.add_insecure_port("[::]:" + port)
+    await server.start()
+    logger.info("Async server started, listening on %s", port)
+    warmup = asyncio.create_task(warm_up(servicer.packet_cache, health_servicer))
+    # open streams are cancelled when the grace period is over, which ends their awaits
+    loop.add_signal_handler(signal.SIGTERM, lambda: asyncio.ensure_future(server.stop(grace=5)))
+    try:
+        await server.wait_for_termination()
+    finally:
+        warmup.cancel()
+        reaper.cancel()
+        await health_servicer.enter_graceful_shutdown()
+        servicer.packet_cache.close()
+        store.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig()
+    asyncio.run(serve())
@@ -0,0 +1,217 @@
+import asyncio
+import logging
+import threading
+import time
+
+from device_manager import DeviceManager
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def device_id_from_context(context):
+    """Read the device_id the client sends in the call metadata."""
+    return dict(context.invocation_metadata()).get('device_id', 'unknown')
+
+
+class SessionEntry():
+    '''
+    A device session plus the bookkeeping the registry needs to decide when it can be evicted
+    '''
+    def __init__(self, session):
+        self.session = session
+        self.active_rpcs = 0
+        self.last_seen = time.monotonic()
+
+
+class StreamLifecycle():
+    '''
+    One streaming RPC's hold on its session. cancel() runs when the RPC terminates, however it ends:
+    client disconnect, cancel, deadline, server shutdown or a normal return. It sets cancelled and runs the
+    on_cancel callbacks once, newest first. The callbacks wake the handler's blocking waits and hand back what it checked out.
+    '''
+    def __init__(self, device_id, rpc):
+        self.device_id = device_id
+        self.rpc = rpc
+        self.cancelled = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def on_cancel(self, callback):
+        """Run callback when the stream ends, straight away if it already has."""
+        with self._lock:
+            if not self.cancelled.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def cancel(self):
+        with self._lock:
+            if self.cancelled.is_set():
+                return
+            self.cancelled.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in reversed(callbacks):
+            try:
+                callback()
+            except Exception:
+                logger.exception("error closing %s for %s", self.rpc, self.device_id)
+
+
+class SessionRegistry():
+    '''
+    One DeviceManager per device_id, so LEDs, mode and the audio/status queues are never shared between devices.
+
+    The map is split into shards, each with its own lock, so lookups from many devices don't
+    all contend on one lock. A session is held open while any of its RPCs are running and is
+    evicted once it has had no RPCs for ttl seconds.
+
+    A new session is built from the state saved for the device in store. The read happens outside the shard
+    lock, and on the grpc.aio server in the executor, so a slow store only holds up the device being loaded.
+    An evicted session's device is dropped from the store's cache too.
+    '''
+    def __init__(self, session_factory=DeviceManager, ttl=600, shards=16, store=None):
+        self.session_factory = session_factory
+        self.store = store
+        self.ttl = ttl
+        self._shards = [({}, threading.Lock()) for _ in range(shards)]
+        # every open stream, so shutdown can end them all
+        self._streams = set()
+        self._streams_lock = threading.Lock()
+
+    def _shard(self, device_id):
+        return self._shards[hash(device_id) % len(self._shards)]
+
+    def get(self, device_id):
+        """Return the session for device_id, or None if it doesn't exist."""
+        entries, lock = self._shard(device_id)
+        with lock:
+            entry = entries.get(device_id)
+            return entry.session if entry else None
+
+    def load(self, device_id):
+        """State saved for device_id, or None. May block on the store, never call it holding a shard lock."""
+        return self.store.load(device_id) if self.store is not None else None
+
+    def _hold(self, device_id, create=False, saved=None):
+        entries, lock = self._shard(device_id)
+        with lock:
+            entry = entries.get(device_id)
+            if entry is None:
+                if not create:
+                    return None
+                entry = SessionEntry(self.session_factory(device_id, saved=saved))
+                entries[device_id] = entry
+                logger.info("new session for device %s", device_id)
+            # if another RPC created the session while we were loading, theirs is used and our state dropped
+            entry.active_rpcs += 1
+            entry.last_seen = time.monotonic()
+            return entry.session
+
+    def acquire(self, device_id):
+        """Get or create the session for device_id and mark one more RPC as using it."""
+        session = self._hold(device_id)
+        if session is None:
+            session = self._hold(device_id, create=True, saved=self.load(device_id))
+        return session
+
+    async def async_acquire(self, device_id):
+        """acquire for the grpc.aio server, the saved state is read in the default executor."""
+        session = self._hold(device_id)
+        if session is None:
+            saved = await asyncio.get_running_loop().run_in_executor(None, self.load, device_id)
+            session = self._hold(device_id, create=True, saved=saved)
+        return session
+
+    def release(self, device_id):
+        """Mark one RPC for device_id as finished, the idle clock starts when the last one ends."""
+        entries, lock = self._shard(device_id)
+        with lock:
+            entry = entries.get(device_id)
+            if entry is not None:
+                entry.active_rpcs -= 1
+                entry.last_seen = time.monotonic()
+
+    def attach(self, context, rpc):
+        """Acquire the session for the device on this RPC and release it when the RPC terminates."""
+        return self.open_stream(context, rpc)[0]
+
+    async def async_attach(self, context, rpc):
+        """attach for the grpc.aio server."""
+        device_id = device_id_from_context(context)
+        return self._track(context, rpc, device_id, await self.async_acquire(device_id))[0]
+
+    def open_stream(self, context, rpc):
+        '''
+        Like attach, also returns the StreamLifecycle for the RPC. A handler that blocks registers
+        on_cancel callbacks to be woken when the RPC goes away, instead of holding a worker thread forever.
+        '''
+        device_id = device_id_from_context(context)
+        return self._track(context, rpc, device_id, self.acquire(device_id))
+
+    def _track(self, context, rpc, device_id, session):
+        stream = StreamLifecycle(device_id, rpc)
+        with self._streams_lock:
+            self._streams.add(stream)
+        metrics.ACTIVE_STREAMS.inc(rpc=rpc)
+
+        def done():
+            stream.cancel()
+            with self._streams_lock:
+                self._streams.discard(stream)
+            self.release(device_id)
+            metrics.ACTIVE_STREAMS.dec(rpc=rpc)
+            logger.debug("%s for %s closed", rpc, device_id)
+        if hasattr(context, "add_done_callback"):
+            # grpc.aio ServicerContext, the callback gets the context
+            context.add_done_callback(lambda _: done())
+        else:
+            context.add_callback(done)
+        return session, stream
+
+    def cancel_streams(self):
+        """Wake and end every open stream, at shutdown so the server stops without waiting out its grace period."""
+        with self._streams_lock:
+            streams = list(self._streams)
+        for stream in streams:
+            stream.cancel()
+        return len(streams)
+
+    def all(self):
+        """Snapshot of every live session, for metrics."""
+        sessions = []
+        for entries, lock in self._shards:
+            with lock:
+                sessions.extend(entry.session for entry in entries.values())
+        return sessions
+
+    def evict_idle(self, now=None):
+        """Drop sessions with no running RPCs that have been idle longer than ttl, return how many were dropped."""
+        now = time.monotonic() if now is None else now
+        evicted = 0
+        for entries, lock in self._shards:
+            with lock:
+                expired = [device_id for device_id, entry in entries.items()
+                           if entry.active_rpcs <= 0 and now - entry.last_seen > self.ttl]
+                for device_id in expired:
+                    del entries[device_id]
+            if self.store is not None:
+                for device_id in expired:
+                    self.store.forget(device_id)
+            evicted += len(expired)
+        if evicted:
+            logger.info("evicted %d idle sessions", evicted)
+        return evicted
+
+    def start_reaper(self, interval=60):
+        """Run evict_idle every interval seconds on a daemon thread, for the threaded server."""
+        def reap():
+            while True:
+                time.sleep(interval)
+                self.evict_idle()
+        thread = threading.Thread(target=reap, name="session-reaper", daemon=True)
+        thread.start()
+        return thread
+
+    def __len__(self):
+        return sum(len(entries) for entries, _ in self._shards)
@@ -0,0 +1,238 @@
+'''
+Device state that outlives a pod: each device's mode and LEDs are saved outside the DeviceManager,
+so a device that reconnects to another replica picks up where it left off. Commands are published
+so the other replicas holding a session for the same device can apply them too.
+'''
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def instance_id():
+    """Name a store on the pub/sub path: pod name, pid and a suffix for stores sharing a process."""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class StateStore():
+    '''
+    Read-through cache with write-behind batching in front of a backend.
+
+    load() only goes to the backend on a cache miss. save() updates the cache and marks the device
+    dirty, a flusher thread writes all dirty devices in one batch every flush_interval, so a burst
+    of button presses costs one write. Commands from other instances refresh a device already in the
+    cache but never add one, state for devices with no session here would only fill memory.
+
+    The cache holds at most cache_size devices, least recently used first out, and the session registry
+    calls forget() when it evicts a device's session. A dropped device is read from the backend again.
+
+    Backends implement _read(device_id), _write(states) and _exchange(messages).
+    _exchange publishes this instance's messages and returns the ones other instances published since the last call.
+    '''
+    def __init__(self, flush_interval=0.05, cache_size=10000):
+        self.flush_interval = flush_interval
+        self.cache_size = cache_size
+        self.origin = instance_id()
+        self._cache = OrderedDict()
+        self._dirty = {}
+        self._outbox = []
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="state-store", daemon=True)
+        self._thread.start()
+
+    def load(self, device_id):
+        """Saved state for device_id as {"mode": int, "leds": [int, ...]}, or None for a new device."""
+        with self._lock:
+            if device_id in self._cache:
+                self._cache.move_to_end(device_id)
+                return self._cache[device_id]
+            if device_id in self._dirty:
+                # dropped from the cache before the flusher wrote it
+                self._remember(device_id, self._dirty[device_id])
+                return self._dirty[device_id]
+        state = self._read(device_id)
+        with self._lock:
+            # a save may have landed while we were reading, it is newer
+            if device_id not in self._cache:
+                self._remember(device_id, state)
+            return self._cache[device_id]
+
+    def save(self, device_id, state):
+        with self._lock:
+            self._remember(device_id, state)
+            self._dirty[device_id] = state
+
+    def forget(self, device_id):
+        """Drop device_id from the cache once it has no session here, a save still waiting is written regardless."""
+        with self._lock:
+            self._cache.pop(device_id, None)
+
+    def _remember(self, device_id, state):
+        self._cache[device_id] = state
+        self._cache.move_to_end(device_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def publish(self, device_id, kind, state):
+        """Tell the other instances a play/mode/stop command was handled for device_id."""
+        with self._lock:
+            self._outbox.append({"device_id": device_id, "kind": kind, "state": state, "origin": self.origin})
+        self._wakeup.set()
+
+    def subscribe(self, callback):
+        """callback(device_id, kind, state) is called from the store thread for commands handled by other instances."""
+        self._subscribers.append(callback)
+
+    def flush(self):
+        """Write dirty state and exchange commands now."""
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+            outbox, self._outbox = self._outbox, []
+        if dirty:
+            self._write(dirty)
+        for message in self._exchange(outbox):
+            if message["origin"] == self.origin:
+                continue
+            with self._lock:
+                if message["device_id"] in self._cache:
+                    self._cache[message["device_id"]] = message["state"]
+            for callback in self._subscribers:
+                try:
+                    callback(message["device_id"], message["kind"], message["state"])
+                except Exception:
+                    logger.exception("error applying remote %s command", message["kind"])
+
+    def close(self):
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join(timeout=1.0)
+        self.flush()
+
+    def _run(self):
+        while not self._closed:
+            # a publish cuts the wait short so commands reach other instances quickly, writes can wait
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("error flushing device state")
+
+    def _read(self, device_id):
+        raise NotImplementedError
+
+    def _write(self, states):
+        raise NotImplementedError
+
+    def _exchange(self, messages):
+        raise NotImplementedError
+
+
+class MemoryStateStore(StateStore):
+    '''
+    Keeps state in this process only, the default for a single replica. Stores created in the same
+    process deliver commands to each other, which is enough to exercise the pub/sub path without a second pod.
+    '''
+    _peers = []
+    _peers_lock = threading.Lock()
+
+    def __init__(self, flush_interval=0.05, cache_size=10000):
+        self._states = {}
+        self._inbox = []
+        with self._peers_lock:
+            self._peers.append(self)
+        super().__init__(flush_interval, cache_size)
+
+    def _read(self, device_id):
+        return self._states.get(device_id)
+
+    def _write(self, states):
+        self._states.update(states)
+
+    def _exchange(self, messages):
+        with self._peers_lock:
+            for peer in self._peers:
+                if peer is not self:
+                    peer._inbox.extend(messages)
+            received, self._inbox = self._inbox, []
+        return received
+
+    def close(self):
+        super().close()
+        with self._peers_lock:
+            self._peers.remove(self)
+
+
+class SqliteStateStore(StateStore):
+    '''
+    State in a SQLite file, a stand-in for a shared store like Redis. Every replica that can open the
+    file (a hostPath volume on a single node cluster) sees the same device state. Commands go through
+    a table that each instance polls from the last row it has seen, rows older than retention seconds are deleted.
+    '''
+    def __init__(self, path, flush_interval=0.05, retention=60, cache_size=10000):
+        self.path = path
+        self.retention = retention
+        self._db = sqlite3.connect(path, timeout=5.0, check_same_thread=False)
+        self._db_lock = threading.Lock()
+        with self._db_lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS device_state "
+                             "(device_id TEXT PRIMARY KEY, state TEXT NOT NULL, updated_at REAL NOT NULL)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS device_command "
+                             "(id INTEGER PRIMARY KEY AUTOINCREMENT, message TEXT NOT NULL, created_at REAL NOT NULL)")
+            # only commands published after we start are of interest
+            self._last_command, = self._db.execute("SELECT COALESCE(MAX(id), 0) FROM device_command").fetchone()
+        self._last_cleanup = time.time()
+        super().__init__(flush_interval, cache_size)
+
+    def _read(self, device_id):
+        with self._db_lock:
+            row = self._db.execute("SELECT state FROM device_state WHERE device_id = ?", (device_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _write(self, states):
+        now = time.time()
+        with self._db_lock, self._db:
+            self._db.executemany(
+                "INSERT INTO device_state (device_id, state, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(device_id) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at",
+                [(device_id, json.dumps(state), now) for device_id, state in states.items()])
+        logger.debug("wrote state for %d devices", len(states))
+
+    def _exchange(self, messages):
+        now = time.time()
+        with self._db_lock, self._db:
+            if messages:
+                self._db.executemany("INSERT INTO device_command (message, created_at) VALUES (?, ?)",
+                                     [(json.dumps(message), now) for message in messages])
+            rows = self._db.execute("SELECT id, message FROM device_command WHERE id > ? ORDER BY id",
+                                    (self._last_command,)).fetchall()
+            if now - self._last_cleanup > self.retention:
+                self._db.execute("DELETE FROM device_command WHERE created_at < ?", (now - self.retention,))
+                self._last_cleanup = now
+        if rows:
+            self._last_command = rows[-1][0]
+        return [json.loads(message) for _, message in rows]
+
+    def close(self):
+        super().close()
+        self._db.close()
+
+
+def open_state_store(url):
+    """Build a store from a URL: "memory" or "sqlite:///path/to/state.db"."""
+    if url == "memory":
+        return MemoryStateStore()
+    if url.startswith("sqlite://"):
+        return SqliteStateStore(url[len("sqlite://"):])
+    raise ValueError(f"unknown state store {url!r}")
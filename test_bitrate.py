@@ -0,0 +1,25 @@
+import time
+
+from bitrate import BitrateController
+from pacing import Pacer, TimerWheel
+
+
+def test_healthy_paced_clip_keeps_its_rung():
+    # a 1s clip sent on time: the lead frames go out at once, the rest on the media clock
+    frame_duration = 0.02
+    pacer = Pacer(TimerWheel(), frame_duration, lead_frames=5)
+    controller = BitrateController(frame_duration)
+    top = controller.bitrate
+    for index in range(1, 50):
+        sent = max(time.monotonic(), pacer.release_time(index))
+        assert controller.observe(pacer.lag(index, sent), 0.0) == top
+
+
+def test_batched_packets_scale_the_thresholds():
+    # 3 frames of 20ms per packet: a send taking most of a frame is normal, the counts are in packets
+    controller = BitrateController(0.02 * 3)
+    top = controller.bitrate
+    for _ in range(10):
+        assert controller.observe(0.0, 0.025) == top
+    assert controller.up_after == 83
+    assert controller.hold == 17
@@ -0,0 +1,23 @@
+'''
+Startup warmup: the server binds its port straight away and reports not ready on the gRPC health
+service, while the audio assets are prepared and encoded into the packet cache here. Readiness flips
+once every asset is cached, so the first plays on a new pod are cache hits.
+The assets are filled a few at a time, with a batch encoder behind the cache that keeps every core busy.
+'''
+import logging
+import time
+from concurrent import futures
+
+logger = logging.getLogger(__name__)
+
+
+def warm_assets(packet_cache, filenames, frame_duration, workers=4):
+    """Prepare and encode every asset into packet_cache at the default format, returns the seconds it took."""
+    started = time.monotonic()
+    with futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="warmup") as pool:
+        fills = [(filename, pool.submit(packet_cache.get, filename, frame_duration)) for filename in filenames]
+        for filename, fill in fills:
+            # a file that can't be read or converted raises here
+            clip = fill.result()
+            logger.info("warmed %s, %d packets", filename, len(clip.packets))
+    return time.monotonic() - started